@@ -5,14 +5,20 @@ Telegram Bot для отслеживания подписок
 
 import os
 import re
+import asyncio
 import sqlite3
 import logging
-from datetime import datetime, timedelta, time as dt_time
-from typing import Optional, List, Tuple, Dict, Any
+import threading
+from collections import OrderedDict, defaultdict
+from datetime import date, datetime, timedelta, time as dt_time
+from functools import lru_cache
+from types import MappingProxyType
+from typing import Optional, List, Tuple, Dict, Set, Mapping, Any, Callable, Awaitable, TypeVar
 from contextlib import contextmanager
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, ReplyKeyboardRemove
 from telegram.ext import (
     Application,
+    BaseUpdateProcessor,
     CommandHandler,
     MessageHandler,
     CallbackQueryHandler,
@@ -31,6 +37,8 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 # ─────────────────────────────────────────────────────────────
 # CONFIG
 # ─────────────────────────────────────────────────────────────
@@ -40,12 +48,21 @@ DB_PATH = os.getenv("DB_PATH", "subs.db")
 MAX_NAME_LENGTH = 100
 MAX_PRICE = 1_000_000
 MAX_SUBSCRIPTIONS_PER_USER = 50
+UPCOMING_DAYS = 30  # горизонт для списка ближайших платежей
 REMINDER_HOUR = 9
 REMINDER_MINUTE = 0
+CONCURRENT_UPDATES = 32  # сколько апдейтов разных пользователей обрабатывается параллельно
+SCHEMA_VERSION = 2  # PRAGMA user_version; увеличивать при новых миграциях
 DEFAULT_PERIOD = "month"
 DEFAULT_CURRENCY = "NOK"
 
-SUPPORTED_CURRENCIES = {"NOK", "EUR", "USD", "RUB", "SEK", "DKK", "GBP"}
+# Подписи периодов (общие для всех сообщений)
+PERIOD_NAMES = {"month": "месяц", "year": "год", "week": "неделя"}
+PERIOD_NAMES_SHORT = {"month": "мес", "year": "год", "week": "нед"}
+PERIOD_NAMES_ADJ = {"month": "ежемесячная", "year": "годовая", "week": "еженедельная"}
+SUPPORTED_PERIODS = frozenset(PERIOD_NAMES)
+
+SUPPORTED_CURRENCIES = frozenset({"NOK", "EUR", "USD", "RUB", "SEK", "DKK", "GBP"})
 
 # Допустимые поля для обновления (защита от SQL-инъекций)
 ALLOWED_SUBSCRIPTION_FIELDS = frozenset({
@@ -55,6 +72,20 @@ ALLOWED_USER_SETTINGS_FIELDS = frozenset({
     "default_currency", "reminder_enabled", "reminder_days", "reminder_hour"
 })
 
+# Тексты запросов для whitelisted-полей собираются один раз: одинаковая строка
+# SQL попадает в кэш подготовленных выражений sqlite3 вместо повторного разбора
+_SQL_UPDATE_SUBSCRIPTION_FIELD = {
+    field: f"UPDATE subscriptions SET {field} = ? WHERE id = ? AND user_id = ?"
+    for field in ALLOWED_SUBSCRIPTION_FIELDS
+}
+_SQL_UPSERT_USER_SETTING = {
+    field: (
+        f"INSERT INTO user_settings (user_id, {field}) VALUES (?, ?) "
+        f"ON CONFLICT(user_id) DO UPDATE SET {field} = excluded.{field}"
+    )
+    for field in ALLOWED_USER_SETTINGS_FIELDS
+}
+
 # ─────────────────────────────────────────────────────────────
 # CURRENCY HELPERS
 # ─────────────────────────────────────────────────────────────
@@ -70,77 +101,162 @@ CURRENCY_ALIASES: Dict[str, str] = {
     "gbp": "GBP", "£": "GBP", "фунт": "GBP", "фунтов": "GBP", "фунта": "GBP",
 }
 
-CURRENCY_SYMBOL: Dict[str, str] = {
+# Только для чтения: из него при импорте строятся форматтеры цен
+CURRENCY_SYMBOL: Mapping[str, str] = MappingProxyType({
     "NOK": "kr", "EUR": "€", "USD": "$", "RUB": "₽",
     "SEK": "kr", "DKK": "kr", "GBP": "£",
+})
+
+
+# Все распознаваемые токены валют в нижнем регистре (коды + алиасы) → код валюты
+_CURRENCY_TOKEN_LOOKUP: Dict[str, str] = {
+    **{cur.lower(): cur for cur in SUPPORTED_CURRENCIES},
+    **CURRENCY_ALIASES,
 }
 
 
 def normalize_currency_token(token: str) -> Optional[str]:
     """Нормализует токен валюты к стандартному виду."""
-    t = token.strip().lower()
-    if t.upper() in SUPPORTED_CURRENCIES:
-        return t.upper()
-    return CURRENCY_ALIASES.get(t)
-
-
-def is_currency_token(token: str) -> bool:
-    """Проверяет, является ли токен валютой."""
-    return normalize_currency_token(token) is not None
+    return _CURRENCY_TOKEN_LOOKUP.get(token.strip().lower())
 
 
 # ─────────────────────────────────────────────────────────────
 # DATABASE CONTEXT MANAGER
 # ─────────────────────────────────────────────────────────────
+# Одно долгоживущее соединение на процесс: не платим за открытие файла и
+# сохраняем кэш страниц SQLite между запросами. Доступ из потоков run_db
+# сериализуется блокировкой. Вложенные get_db() работают в транзакции
+# внешнего блока, коммит делает только он.
+_db_conn: Optional[sqlite3.Connection] = None
+_db_lock = threading.RLock()
+_db_depth = 0
+
+
+def _open_db() -> sqlite3.Connection:
+    """Открывает соединение с БД и настраивает его один раз."""
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False)
+    conn.row_factory = sqlite3.Row
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute("PRAGMA cache_size=-20000")
+    return conn
+
+
 @contextmanager
 def get_db():
     """Контекстный менеджер для безопасной работы с БД."""
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    try:
-        yield conn
-        conn.commit()
-    except Exception:
-        conn.rollback()
-        raise
-    finally:
-        conn.close()
+    global _db_conn, _db_depth
+    with _db_lock:
+        if _db_conn is None:
+            _db_conn = _open_db()
+        conn = _db_conn
+        _db_depth += 1
+        try:
+            yield conn
+            if _db_depth == 1:
+                conn.commit()
+        except Exception:
+            if _db_depth == 1:
+                conn.rollback()
+            raise
+        finally:
+            _db_depth -= 1
+
+
+def close_db():
+    """Закрывает общее соединение с БД."""
+    global _db_conn
+    with _db_lock:
+        if _db_conn is not None:
+            _db_conn.close()
+            _db_conn = None
+
+
+async def run_db(func: Callable[..., T], *args: Any, **kwargs: Any) -> T:
+    """
+    Выполняет синхронную функцию работы с БД в пуле потоков,
+    чтобы sqlite не блокировал event loop.
+    """
+    return await asyncio.to_thread(func, *args, **kwargs)
+
+
+# Кэш списков подписок по пользователям. Все записи в subscriptions идут
+# через функции ниже, и каждая сбрасывает запись пользователя, поэтому TTL
+# не нужен. Доступ — под _db_lock, как и к соединению. Записи неизменяемы
+# (кортеж MappingProxyType), чтобы вызывающий код не мог испортить кэш.
+SUBS_CACHE_MAX_USERS = 10000
+_subs_cache: "OrderedDict[int, Tuple[Mapping[str, Any], ...]]" = OrderedDict()
+
+
+def _invalidate_subs_cache(user_id: int) -> None:
+    """Сбрасывает закэшированный список подписок пользователя."""
+    with _db_lock:
+        _subs_cache.pop(user_id, None)
+
+
+# Кэш годовой статистики: (user_id, год) → строки (кортеж, только для чтения).
+# Год приходит из callback_data, поэтому LRU ограничен общим числом записей,
+# а не числом пользователей. _stats_cache_years — годы пользователя в кэше,
+# чтобы сбросить их без обхода всего LRU. Платежи пишет только add_payment,
+# он и сбрасывает записи пользователя.
+STATS_CACHE_MAX_ENTRIES = 20000
+_stats_cache: "OrderedDict[Tuple[int, int], Tuple[Tuple[str, int, float], ...]]" = OrderedDict()
+_stats_cache_years: Dict[int, Set[int]] = {}
+
+
+def _invalidate_stats_cache(user_id: int) -> None:
+    """Сбрасывает закэшированную статистику пользователя."""
+    with _db_lock:
+        for year in _stats_cache_years.pop(user_id, ()):
+            _stats_cache.pop((user_id, year), None)
 
 
 # ─────────────────────────────────────────────────────────────
 # PRICE HELPERS
 # ─────────────────────────────────────────────────────────────
-def parse_price(input_str: str) -> Optional[Tuple[float, str]]:
+# Регулярки разбора цены компилируются один раз при импорте
+_PREFIX_PRICE_RE = re.compile(r'([€$£₽])\s*(\d+[.,]?\d*)')
+_AMOUNT_RE = re.compile(r'\d+[.,]?\d*|[.,]\d+')
+
+
+def _parse_amount(num: str) -> Optional[float]:
+    """Разбирает сумму без исключений; None, если это не число или оно вне диапазона."""
+    if not _AMOUNT_RE.fullmatch(num):
+        return None
+    amount = float(num.replace(",", "."))
+    if 0 < amount <= MAX_PRICE:
+        return amount
+    return None
+
+
+def parse_price(input_str: str) -> Optional[Tuple[float, Optional[str]]]:
     """
     Парсит строку с ценой и валютой.
     Поддерживает форматы: "129", "129 kr", "€9.99", "9,99 EUR"
+    Валюта None — в вводе её нет (как в try_parse_quick_add), вызывающий
+    подставляет валюту из настроек пользователя.
     """
     input_str = input_str.strip()
     if not input_str:
         return None
     
-    # Попытка распарсить формат с символом валюты в начале (€100, $50)
-    currency_prefix_match = re.match(r'^([€$£₽])\s*(\d+[.,]?\d*)$', input_str)
+    # Быстрый путь для самого частого ввода — одно число без валюты
+    amount = _parse_amount(input_str)
+    if amount is not None:
+        return (amount, None)
+    
+    # Формат с символом валюты в начале (€100, $50)
+    currency_prefix_match = _PREFIX_PRICE_RE.fullmatch(input_str)
     if currency_prefix_match:
         symbol, num = currency_prefix_match.groups()
-        currency = normalize_currency_token(symbol)
-        if currency:
-            try:
-                amount = float(num.replace(",", "."))
-                if 0 < amount <= MAX_PRICE:
-                    return (amount, currency)
-            except ValueError:
-                pass
+        amount = _parse_amount(num)
+        if amount is not None:
+            return (amount, CURRENCY_ALIASES[symbol])
+        return None
     
     parts = input_str.split()
-    if len(parts) == 1:
-        try:
-            amount = float(parts[0].replace(",", ".").replace(" ", ""))
-            if 0 < amount <= MAX_PRICE:
-                return (amount, DEFAULT_CURRENCY)
-        except ValueError:
-            return None
-    elif len(parts) == 2:
+    if len(parts) == 2:
         num_part, cur_part = parts[0], parts[1]
         currency = normalize_currency_token(cur_part)
         if not currency:
@@ -150,12 +266,9 @@ def parse_price(input_str: str) -> Optional[Tuple[float, str]]:
                 num_part = cur_part
             else:
                 return None
-        try:
-            amount = float(num_part.replace(",", ".").replace(" ", ""))
-            if 0 < amount <= MAX_PRICE:
-                return (amount, currency)
-        except ValueError:
-            return None
+        amount = _parse_amount(num_part)
+        if amount is not None:
+            return (amount, currency)
     return None
 
 
@@ -164,8 +277,20 @@ def pack_price(amount: float, currency: str) -> str:
     return f"{amount:.2f} {currency}"
 
 
+# Канонический формат, который пишет pack_price: "129.00 NOK"
+_CANONICAL_PRICE_RE = re.compile(r"(\d+(?:\.\d{1,2})?) ([A-Z]{3})")
+
+
+@lru_cache(maxsize=1024)
 def unpack_price(price_str: str) -> Tuple[float, str]:
-    """Распаковывает строку цены в кортеж (сумма, валюта)."""
+    """
+    Распаковывает строку цены в кортеж (сумма, валюта).
+    Различных цен в БД немного, поэтому результат кэшируется.
+    """
+    match = _CANONICAL_PRICE_RE.fullmatch(price_str)
+    if match:
+        return (float(match.group(1)), match.group(2))
+    
     parts = price_str.strip().split()
     if len(parts) == 2:
         try:
@@ -175,11 +300,45 @@ def unpack_price(price_str: str) -> Tuple[float, str]:
     return (0.0, DEFAULT_CURRENCY)
 
 
+_AMOUNT_TRANS = str.maketrans({",": " ", ".": ","})
+
+
+def format_amount(amount: float) -> str:
+    """Форматирует сумму: пробел между разрядами, запятая перед копейками."""
+    return f"{amount:,.2f}".translate(_AMOUNT_TRANS)
+
+
+def format_whole_amount(amount: float) -> str:
+    """Форматирует сумму без копеек с пробелом между разрядами (для статистики)."""
+    return f"{amount:,.0f}".replace(",", " ")
+
+
+def _make_price_formatter(symbol: str) -> Callable[[float], str]:
+    """Создаёт форматтер цены с заранее подставленным символом валюты."""
+    suffix = f" {symbol}"
+
+    def formatter(amount: float) -> str:
+        return format_amount(amount) + suffix
+
+    return formatter
+
+
+# Форматтеры для известных валют строятся один раз при импорте
+_PRICE_FORMATTERS: Dict[str, Callable[[float], str]] = {
+    currency: _make_price_formatter(symbol) for currency, symbol in CURRENCY_SYMBOL.items()
+}
+
+
+@lru_cache(maxsize=2048)
 def format_price(amount: float, currency: str) -> str:
-    """Форматирует цену для отображения пользователю."""
-    symbol = CURRENCY_SYMBOL.get(currency, currency)
-    formatted = f"{amount:,.2f}".replace(",", " ").replace(".", ",")
-    return f"{formatted} {symbol}"
+    """
+    Форматирует цену для отображения пользователю.
+    Цены в списках часто повторяются, поэтому результат кэшируется.
+    """
+    formatter = _PRICE_FORMATTERS.get(currency)
+    if formatter:
+        return formatter(amount)
+    return f"{format_amount(amount)} {currency}"
 
 
 # ─────────────────────────────────────────────────────────────
@@ -190,14 +349,6 @@ def escape_md(text: str) -> str:
     return escape_markdown(str(text), version=2)
 
 
-def safe_markdown(text: str, bold: bool = False) -> str:
-    """Возвращает безопасный текст для Markdown, опционально жирный."""
-    escaped = escape_md(text)
-    if bold:
-        return f"*{escaped}*"
-    return escaped
-
-
 # ─────────────────────────────────────────────────────────────
 # KNOWN SERVICES
 # ─────────────────────────────────────────────────────────────
@@ -245,6 +396,8 @@ def init_db():
                 user_id INTEGER NOT NULL,
                 name TEXT NOT NULL,
                 price TEXT NOT NULL,
+                price_amount REAL,
+                price_currency TEXT,
                 next_date TEXT NOT NULL,
                 period TEXT DEFAULT 'month',
                 last_charge_date TEXT,
@@ -271,6 +424,8 @@ def init_db():
                 user_id INTEGER NOT NULL,
                 subscription_id INTEGER NOT NULL,
                 amount TEXT NOT NULL,
+                amount_value REAL,
+                amount_currency TEXT,
                 paid_at TEXT NOT NULL,
                 created_at TEXT DEFAULT CURRENT_TIMESTAMP
             )
@@ -289,42 +444,89 @@ def init_db():
         """)
 
         # Создаём индексы для производительности
-        c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user_id ON subscriptions(user_id)")
+        # Составной индекс покрывает WHERE user_id = ? ORDER BY next_date без сортировки
+        c.execute("DROP INDEX IF EXISTS idx_subscriptions_user_id")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user_next ON subscriptions(user_id, next_date)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_next_date ON subscriptions(next_date)")
-        c.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_id ON payment_history(user_id)")
+        # Поиск дубликата идёт по LOWER(name) — индекс по тому же выражению
+        c.execute("CREATE INDEX IF NOT EXISTS idx_subscriptions_user_name ON subscriptions(user_id, LOWER(name))")
+        c.execute("DROP INDEX IF EXISTS idx_payments_user_id")
+        c.execute("CREATE INDEX IF NOT EXISTS idx_payments_user_paid_at ON payment_history(user_id, paid_at)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_payments_paid_at ON payment_history(paid_at)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_temp_data_user ON temp_data(user_id, data_key)")
         c.execute("CREATE INDEX IF NOT EXISTS idx_temp_data_expires ON temp_data(expires_at)")
 
-        # Миграции для subscriptions
-        existing_cols = {row[1] for row in c.execute("PRAGMA table_info(subscriptions)").fetchall()}
-        migrations = [
-            ("period", "TEXT DEFAULT 'month'"),
-            ("last_charge_date", "TEXT"),
-            ("category", "TEXT DEFAULT '📦 Другое'"),
-            ("is_paused", "INTEGER DEFAULT 0"),
-        ]
-        for col, col_type in migrations:
-            if col not in existing_cols:
-                try:
-                    c.execute(f"ALTER TABLE subscriptions ADD COLUMN {col} {col_type}")
-                except sqlite3.OperationalError:
-                    pass
-
-        # Миграции для user_settings
-        existing_cols = {row[1] for row in c.execute("PRAGMA table_info(user_settings)").fetchall()}
-        migrations = [
-            ("reminder_enabled", "INTEGER DEFAULT 1"),
-            ("reminder_days", "TEXT DEFAULT '1,3'"),
-            ("reminder_hour", "INTEGER DEFAULT 9"),
-            ("timezone", "TEXT DEFAULT 'UTC'"),
-        ]
-        for col, col_type in migrations:
-            if col not in existing_cols:
-                try:
-                    c.execute(f"ALTER TABLE user_settings ADD COLUMN {col} {col_type}")
-                except sqlite3.OperationalError:
-                    pass
+        # Миграции выполняются только если схема старше текущей версии
+        schema_version = c.execute("PRAGMA user_version").fetchone()[0]
+        if schema_version < SCHEMA_VERSION:
+            migrate_db(c)
+            c.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        backfill_typed_prices(c)
+
+        # Обновляем статистику планировщика, чтобы новые индексы использовались
+        c.execute("PRAGMA optimize")
+
+
+def backfill_typed_prices(c: sqlite3.Cursor):
+    """
+    Раскладывает упакованные цены по типизированным колонкам там, где они пусты.
+    Выполняется при каждом запуске, а не только при миграции: строки, записанные
+    старой сборкой (она пишет только price/amount), иначе остались бы с NULL.
+    """
+    rows = c.execute("SELECT id, price FROM subscriptions WHERE price_amount IS NULL").fetchall()
+    c.executemany(
+        "UPDATE subscriptions SET price_amount = ?, price_currency = ? WHERE id = ?",
+        [(*unpack_price(price), row_id) for row_id, price in rows]
+    )
+    rows = c.execute("SELECT id, amount FROM payment_history WHERE amount_value IS NULL").fetchall()
+    c.executemany(
+        "UPDATE payment_history SET amount_value = ?, amount_currency = ? WHERE id = ?",
+        [(*unpack_price(amount), row_id) for row_id, amount in rows]
+    )
+
+
+def migrate_db(c: sqlite3.Cursor):
+    """Добавляет недостающие колонки в таблицы старых версий."""
+    # Миграции для subscriptions
+    existing_cols = {row[1] for row in c.execute("PRAGMA table_info(subscriptions)").fetchall()}
+    migrations = [
+        ("period", "TEXT DEFAULT 'month'"),
+        ("last_charge_date", "TEXT"),
+        ("category", "TEXT DEFAULT '📦 Другое'"),
+        ("is_paused", "INTEGER DEFAULT 0"),
+        ("price_amount", "REAL"),
+        ("price_currency", "TEXT"),
+    ]
+    for col, col_type in migrations:
+        if col not in existing_cols:
+            try:
+                c.execute(f"ALTER TABLE subscriptions ADD COLUMN {col} {col_type}")
+            except sqlite3.OperationalError:
+                pass
+    
+    # Миграции для payment_history
+    existing_cols = {row[1] for row in c.execute("PRAGMA table_info(payment_history)").fetchall()}
+    for col, col_type in [("amount_value", "REAL"), ("amount_currency", "TEXT")]:
+        if col not in existing_cols:
+            try:
+                c.execute(f"ALTER TABLE payment_history ADD COLUMN {col} {col_type}")
+            except sqlite3.OperationalError:
+                pass
+    
+    # Миграции для user_settings
+    existing_cols = {row[1] for row in c.execute("PRAGMA table_info(user_settings)").fetchall()}
+    migrations = [
+        ("reminder_enabled", "INTEGER DEFAULT 1"),
+        ("reminder_days", "TEXT DEFAULT '1,3'"),
+        ("reminder_hour", "INTEGER DEFAULT 9"),
+        ("timezone", "TEXT DEFAULT 'UTC'"),
+    ]
+    for col, col_type in migrations:
+        if col not in existing_cols:
+            try:
+                c.execute(f"ALTER TABLE user_settings ADD COLUMN {col} {col_type}")
+            except sqlite3.OperationalError:
+                pass
 
 
 def cleanup_expired_temp_data():
@@ -410,10 +612,7 @@ def save_user_setting(user_id: int, field: str, value: Any) -> bool:
     with get_db() as conn:
         c = conn.cursor()
         # SQLite UPSERT синтаксис
-        c.execute(f"""
-            INSERT INTO user_settings (user_id, {field}) VALUES (?, ?)
-            ON CONFLICT(user_id) DO UPDATE SET {field} = excluded.{field}
-        """, (user_id, value))
+        c.execute(_SQL_UPSERT_USER_SETTING[field], (user_id, value))
         return True
 
 
@@ -424,12 +623,15 @@ def add_subscription(user_id: int, name: str, price: str, next_date: str,
                      period: str = "month", last_charge_date: str = None,
                      category: str = "📦 Другое") -> int:
     """Добавляет новую подписку и возвращает её ID."""
+    amount, currency = unpack_price(price)
     with get_db() as conn:
         c = conn.cursor()
         c.execute("""
-            INSERT INTO subscriptions (user_id, name, price, next_date, period, last_charge_date, category)
-            VALUES (?, ?, ?, ?, ?, ?, ?)
-        """, (user_id, name, price, next_date, period, last_charge_date, category))
+            INSERT INTO subscriptions (user_id, name, price, price_amount, price_currency,
+                                       next_date, period, last_charge_date, category)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (user_id, name, price, amount, currency, next_date, period, last_charge_date, category))
+        _invalidate_subs_cache(user_id)
         return c.lastrowid
 
 
@@ -438,7 +640,8 @@ def find_duplicate_subscription(user_id: int, name: str) -> Optional[Dict[str, A
     with get_db() as conn:
         c = conn.cursor()
         c.execute("""
-            SELECT id, name, price, period, next_date, last_charge_date, category, is_paused
+            SELECT id, name, price, period, next_date, last_charge_date, category, is_paused,
+                   price_amount, price_currency
             FROM subscriptions WHERE user_id = ? AND LOWER(name) = LOWER(?)
         """, (user_id, name))
         row = c.fetchone()
@@ -446,24 +649,54 @@ def find_duplicate_subscription(user_id: int, name: str) -> Optional[Dict[str, A
             return {
                 "id": row[0], "name": row[1], "price": row[2], "period": row[3],
                 "next_date": row[4], "last_charge_date": row[5], 
-                "category": row[6], "is_paused": row[7]
+                "category": row[6], "is_paused": row[7],
+                "amount": row[8], "currency": row[9]
             }
         return None
 
 
-def list_subscriptions(user_id: int) -> List[Dict[str, Any]]:
-    """Возвращает список подписок пользователя."""
+def list_subscriptions(user_id: int) -> Tuple[Mapping[str, Any], ...]:
+    """
+    Возвращает подписки пользователя (только для чтения).
+    Результат кэшируется до первой записи по этому пользователю.
+    """
     with get_db() as conn:
+        cached = _subs_cache.get(user_id)
+        if cached is not None:
+            _subs_cache.move_to_end(user_id)
+            return cached
+        
         c = conn.cursor()
         c.execute("""
-            SELECT id, name, price, next_date, period, category, is_paused
+            SELECT id, name, price, next_date, period, category, is_paused,
+                   price_amount, price_currency
             FROM subscriptions WHERE user_id = ? ORDER BY next_date
         """, (user_id,))
         rows = c.fetchall()
-        return [
-            {"id": r[0], "name": r[1], "price": r[2], "next_date": r[3],
-             "period": r[4], "category": r[5], "is_paused": r[6]}
+        subs = tuple(
+            MappingProxyType({"id": r[0], "name": r[1], "price": r[2], "next_date": r[3],
+                              "period": r[4], "category": r[5], "is_paused": r[6],
+                              "amount": r[7], "currency": r[8]})
             for r in rows
+        )
+        _subs_cache[user_id] = subs
+        if len(_subs_cache) > SUBS_CACHE_MAX_USERS:
+            _subs_cache.popitem(last=False)
+        return subs
+
+
+def list_upcoming_subscriptions(user_id: int, until: str) -> List[Dict[str, Any]]:
+    """Возвращает активные подписки с платежом не позже until (YYYY-MM-DD)."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+            SELECT name, price_amount, price_currency, next_date FROM subscriptions
+            WHERE user_id = ? AND next_date <= ? AND COALESCE(is_paused, 0) = 0
+            ORDER BY next_date
+        """, (user_id, until))
+        return [
+            {"name": r[0], "amount": r[1], "currency": r[2], "next_date": r[3]}
+            for r in c.fetchall()
         ]
 
 
@@ -472,7 +705,8 @@ def get_subscription(sub_id: int) -> Optional[Dict[str, Any]]:
     with get_db() as conn:
         c = conn.cursor()
         c.execute("""
-            SELECT id, name, price, next_date, period, last_charge_date, category, is_paused, user_id
+            SELECT id, name, price, next_date, period, last_charge_date, category, is_paused, user_id,
+                   price_amount, price_currency
             FROM subscriptions WHERE id = ?
         """, (sub_id,))
         row = c.fetchone()
@@ -480,7 +714,8 @@ def get_subscription(sub_id: int) -> Optional[Dict[str, Any]]:
             return {
                 "id": row[0], "name": row[1], "price": row[2], "next_date": row[3],
                 "period": row[4], "last_charge_date": row[5], "category": row[6],
-                "is_paused": row[7], "user_id": row[8]
+                "is_paused": row[7], "user_id": row[8],
+                "amount": row[9], "currency": row[10]
             }
         return None
 
@@ -498,6 +733,7 @@ def delete_subscription(sub_id: int, user_id: int) -> bool:
     with get_db() as conn:
         c = conn.cursor()
         c.execute("DELETE FROM subscriptions WHERE id = ? AND user_id = ?", (sub_id, user_id))
+        _invalidate_subs_cache(user_id)
         return c.rowcount > 0
 
 
@@ -509,14 +745,24 @@ def update_subscription_field(sub_id: int, field: str, value: Any, user_id: int)
     if field not in ALLOWED_SUBSCRIPTION_FIELDS:
         logger.error(f"Попытка обновить недопустимое поле подписки: {field}")
         return False
+    if field == "price":
+        # Цена пишется вместе с типизированными колонками
+        return update_subscription_fields(sub_id, {"price": value}, user_id)
     
     with get_db() as conn:
         c = conn.cursor()
-        c.execute(f"UPDATE subscriptions SET {field} = ? WHERE id = ? AND user_id = ?", 
-                  (value, sub_id, user_id))
+        c.execute(_SQL_UPDATE_SUBSCRIPTION_FIELD[field], (value, sub_id, user_id))
+        _invalidate_subs_cache(user_id)
         return c.rowcount > 0
 
 
+@lru_cache(maxsize=64)
+def _sql_update_subscription_fields(fields: Tuple[str, ...]) -> str:
+    """Собирает UPDATE для набора полей; комбинаций в коде немного, поэтому кэшируем."""
+    set_clause = ", ".join(f"{field} = ?" for field in fields)
+    return f"UPDATE subscriptions SET {set_clause} WHERE id = ? AND user_id = ?"
+
+
 def update_subscription_fields(sub_id: int, updates: Dict[str, Any], user_id: int) -> bool:
     """Обновляет несколько полей подписки за один запрос."""
     # Проверяем все поля
@@ -528,12 +774,74 @@ def update_subscription_fields(sub_id: int, updates: Dict[str, Any], user_id: in
     if not updates:
         return False
     
-    set_clause = ", ".join(f"{field} = ?" for field in updates.keys())
-    values = list(updates.values()) + [sub_id, user_id]
+    if "price" in updates:
+        amount, currency = unpack_price(updates["price"])
+        updates = {**updates, "price_amount": amount, "price_currency": currency}
+    
+    sql = _sql_update_subscription_fields(tuple(updates))
+    values = (*updates.values(), sub_id, user_id)
     
     with get_db() as conn:
         c = conn.cursor()
-        c.execute(f"UPDATE subscriptions SET {set_clause} WHERE id = ? AND user_id = ?", values)
+        c.execute(sql, values)
+        _invalidate_subs_cache(user_id)
+        return c.rowcount > 0
+
+
+def toggle_subscription_pause(sub_id: int, user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Переключает паузу подписки одним запросом (UPDATE ... RETURNING).
+    Возвращает название и новый статус или None, если подписка не найдена.
+    """
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE subscriptions SET is_paused = 1 - COALESCE(is_paused, 0)
+            WHERE id = ? AND user_id = ?
+            RETURNING name, is_paused
+        """, (sub_id, user_id))
+        row = c.fetchone()
+        _invalidate_subs_cache(user_id)
+        if row:
+            return {"name": row[0], "is_paused": row[1]}
+        return None
+
+
+def set_subscription_period(sub_id: int, period: str, user_id: int) -> Optional[Dict[str, Any]]:
+    """
+    Меняет период подписки и пересчитывает next_date от последней оплаты
+    за одно обращение к БД (UPDATE ... RETURNING вместо SELECT + UPDATE).
+    Возвращает название подписки или None, если она не найдена.
+    """
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("""
+            UPDATE subscriptions SET period = ?
+            WHERE id = ? AND user_id = ?
+            RETURNING name, last_charge_date
+        """, (period, sub_id, user_id))
+        row = c.fetchone()
+        if not row:
+            return None
+        name, last_charge_date = row
+        if last_charge_date:
+            new_next = next_from_last(parse_iso_date(last_charge_date), period)
+            c.execute("UPDATE subscriptions SET next_date = ? WHERE id = ?",
+                      (new_next.strftime("%Y-%m-%d"), sub_id))
+        _invalidate_subs_cache(user_id)
+        return {"name": name}
+
+
+def rename_subscription(sub_id: int, name: str, user_id: int) -> bool:
+    """
+    Переименовывает подписку с проверкой владельца.
+    name не входит в ALLOWED_SUBSCRIPTION_FIELDS, поэтому отдельный запрос.
+    """
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute("UPDATE subscriptions SET name = ? WHERE id = ? AND user_id = ?",
+                  (name, sub_id, user_id))
+        _invalidate_subs_cache(user_id)
         return c.rowcount > 0
 
 
@@ -545,106 +853,271 @@ def count_user_subscriptions(user_id: int) -> int:
         return c.fetchone()[0]
 
 
+def get_add_precheck(user_id: int, name: str) -> Tuple[int, Optional[Dict[str, Any]]]:
+    """Количество подписок пользователя и дубликат по названию за одно обращение к БД."""
+    with get_db():
+        return count_user_subscriptions(user_id), find_duplicate_subscription(user_id, name)
+
+
 def add_payment(user_id: int, subscription_id: int, amount: str, paid_at: str):
     """Добавляет запись о платеже."""
+    value, currency = unpack_price(amount)
     with get_db() as conn:
         c = conn.cursor()
         c.execute("""
-            INSERT INTO payment_history (user_id, subscription_id, amount, paid_at)
-            VALUES (?, ?, ?, ?)
-        """, (user_id, subscription_id, amount, paid_at))
+            INSERT INTO payment_history (user_id, subscription_id, amount, amount_value, amount_currency, paid_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (user_id, subscription_id, amount, value, currency, paid_at))
+        _invalidate_stats_cache(user_id)
+
+
+def add_subscription_with_payment(user_id: int, name: str, price: str, next_date: str,
+                                  period: str, last_charge_date: str, category: str) -> int:
+    """Добавляет подписку вместе с первым платежом одной транзакцией."""
+    with get_db():
+        new_id = add_subscription(user_id, name, price, next_date, period, last_charge_date, category)
+        add_payment(user_id, new_id, price, last_charge_date)
+        return new_id
+
+
+def record_subscription_payment(sub_id: int, user_id: int, updates: Dict[str, Any],
+                                price: str, paid_at: str) -> bool:
+    """Обновляет поля подписки и записывает платёж одной транзакцией."""
+    with get_db():
+        if not update_subscription_fields(sub_id, updates, user_id):
+            return False
+        add_payment(user_id, sub_id, price, paid_at)
+        return True
 
 
-def get_payments_for_year(user_id: int, year: int) -> List[Dict[str, Any]]:
-    """Получает платежи за указанный год."""
+def get_year_stats(user_id: int, year: int) -> Tuple[Tuple[str, int, float], ...]:
+    """
+    Суммы платежей за год по валютам и месяцам: (валюта, месяц, сумма).
+    Агрегация выполняется в SQLite, строки отсортированы по валюте и месяцу.
+    Результат кэшируется до следующего платежа пользователя.
+    """
     with get_db() as conn:
+        key = (user_id, year)
+        cached = _stats_cache.get(key)
+        if cached is not None:
+            _stats_cache.move_to_end(key)
+            return cached
+        
         c = conn.cursor()
         c.execute("""
-            SELECT subscription_id, amount, paid_at FROM payment_history
-            WHERE user_id = ? AND paid_at LIKE ? ORDER BY paid_at
-        """, (user_id, f"{year}-%"))
-        return [
-            {"subscription_id": r[0], "amount": r[1], "paid_at": r[2]}
-            for r in c.fetchall()
-        ]
+            SELECT amount_currency, CAST(strftime('%m', paid_at) AS INTEGER) AS month, SUM(amount_value)
+            FROM payment_history
+            WHERE user_id = ? AND paid_at >= ? AND paid_at < ? AND month IS NOT NULL
+            GROUP BY amount_currency, month
+            ORDER BY amount_currency, month
+        """, (user_id, f"{year:04d}-01-01", f"{year + 1:04d}-01-01"))
+        rows = tuple((r[0], r[1], r[2]) for r in c.fetchall())
+        
+        _stats_cache[key] = rows
+        _stats_cache_years.setdefault(user_id, set()).add(year)
+        if len(_stats_cache) > STATS_CACHE_MAX_ENTRIES:
+            (old_user, old_year), _ = _stats_cache.popitem(last=False)
+            old_years = _stats_cache_years[old_user]
+            old_years.discard(old_year)
+            if not old_years:
+                del _stats_cache_years[old_user]
+        return rows
+
+
+def get_payment_history(user_id: int) -> List[sqlite3.Row]:
+    """Получает всю историю платежей пользователя (для /debug)."""
+    with get_db() as conn:
+        c = conn.cursor()
+        c.execute(
+            "SELECT id, subscription_id, amount, paid_at FROM payment_history WHERE user_id = ?",
+            (user_id,)
+        )
+        return c.fetchall()
+
+
+def get_reminder_data() -> Tuple[List[sqlite3.Row], List[sqlite3.Row]]:
+    """Получает активные подписки и настройки напоминаний всех пользователей."""
+    with get_db() as conn:
+        c = conn.cursor()
+        
+        # Получаем все активные подписки
+        c.execute("""
+            SELECT s.user_id, s.name, s.price_amount, s.price_currency, s.next_date
+            FROM subscriptions s
+            WHERE s.is_paused = 0
+        """)
+        all_subs = c.fetchall()
+        
+        # Получаем настройки всех пользователей
+        c.execute("SELECT user_id, reminder_enabled, reminder_days FROM user_settings")
+        settings_rows = c.fetchall()
+    
+    return all_subs, settings_rows
 
 
 # ─────────────────────────────────────────────────────────────
 # DATE HELPERS
 # ─────────────────────────────────────────────────────────────
+_MDAYS = (31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
+
+
+def days_in_month(year: int, month: int) -> int:
+    """Количество дней в месяце по таблице с учётом високосного февраля."""
+    if month == 2 and year % 4 == 0 and (year % 100 != 0 or year % 400 == 0):
+        return 29
+    return _MDAYS[month - 1]
+
+
 def parse_date(text: str) -> Optional[datetime]:
-    """Парсит дату из различных форматов."""
+    """
+    Парсит дату из различных форматов:
+    ДД.ММ.ГГГГ, ДД.ММ.ГГ (или через "/") и ГГГГ-ММ-ДД.
+    Разбор ручной — split и int, без regex и strptime.
+    """
     text = text.strip()
-    for fmt in ["%d.%m.%Y", "%d.%m.%y", "%d/%m/%Y", "%d/%m/%y", "%Y-%m-%d"]:
-        try:
-            return datetime.strptime(text, fmt)
-        except ValueError:
-            continue
-    return None
+    if "-" in text:
+        parts = text.split("-")
+        if len(parts) != 3:
+            return None
+        year_str, month, day = parts
+        if len(year_str) != 4:
+            return None
+    else:
+        parts = text.split("." if "." in text else "/")
+        if len(parts) != 3:
+            return None
+        day, month, year_str = parts
+        if len(year_str) not in (2, 4):
+            return None
+    
+    if not (0 < len(day) <= 2 and 0 < len(month) <= 2):
+        return None
+    if not (day.isdecimal() and month.isdecimal() and year_str.isdecimal()):
+        return None
+    
+    year = int(year_str)
+    if len(year_str) == 2:
+        # Как у strptime("%y"): 69–99 → 19xx, 00–68 → 20xx
+        year += 1900 if year >= 69 else 2000
+    try:
+        return datetime(year, int(month), int(day))
+    except ValueError:
+        return None
 
 
-def next_from_last(last_dt: datetime, period: str = "month") -> datetime:
+def next_from_last(last_dt: date, period: str = "month") -> datetime:
     """
     Вычисляет следующую дату платежа от последней.
     Если последняя дата в будущем, возвращает её.
+    last_dt — date или datetime: используются только год, месяц, день и ordinal.
     """
     today = datetime.now().date()
-    candidate = last_dt.date()
     
-    # Если дата уже в будущем или сегодня, возвращаем её
-    if candidate >= today:
-        return datetime.combine(candidate, datetime.min.time())
-    
-    while candidate < today:
+    if period == "week":
+        # Номер дня (rata die): сразу перескакиваем нужное число недель
+        rd = last_dt.toordinal()
+        today_rd = today.toordinal()
+        if rd < today_rd:
+            rd += -(-(today_rd - rd) // 7) * 7
+        return datetime.fromordinal(rd)
+    
+    # Сравниваем даты как целые YYYYMMDD, без промежуточных объектов date
+    today_key = today.year * 10000 + today.month * 100 + today.day
+    year, month, day = last_dt.year, last_dt.month, last_dt.day
+    if year * 10000 + month * 100 + day >= today_key:
+        return datetime(year, month, day)
+    
+    if period == "year":
+        # Сразу переходим в текущий год. 29 февраля после первого же шага
+        # попадает в невисокосный год и становится 28-м
+        if today.year > year and month == 2 and day == 29:
+            day = 28
+        year = today.year
+    else:  # month
+        months = (today.year - year) * 12 + today.month - month
+        # День 29–31 обрезается самым коротким месяцем на пути, поэтому пока
+        # такое возможно, идём по месяцам (не дольше пары лет: дальше день ≤ 28)
+        while months > 0 and day > 28:
+            month = month % 12 + 1
+            if month == 1:
+                year += 1
+            day = min(day, days_in_month(year, month))
+            months -= 1
+        # Остаток пути — сразу до текущего месяца
+        year, month = divmod(year * 12 + month - 1 + months, 12)
+        month += 1
+    
+    # Дата в текущем месяце/году может быть ещё в прошлом — один шаг вперёд
+    if year * 10000 + month * 100 + day < today_key:
         if period == "year":
-            try:
-                candidate = candidate.replace(year=candidate.year + 1)
-            except ValueError:
-                # 29 февраля -> 28 февраля
-                candidate = candidate.replace(year=candidate.year + 1, day=28)
-        elif period == "week":
-            candidate += timedelta(days=7)
-        else:  # month
-            month = candidate.month + 1
-            year = candidate.year
-            if month > 12:
-                month = 1
+            year += 1
+        else:
+            month = month % 12 + 1
+            if month == 1:
                 year += 1
-            day = candidate.day
-            # Обработка случаев, когда день больше, чем дней в месяце
-            while True:
-                try:
-                    candidate = candidate.replace(year=year, month=month, day=day)
-                    break
-                except ValueError:
-                    day -= 1
-                    if day < 1:
-                        day = 28
-                        break
-    
-    return datetime.combine(candidate, datetime.min.time())
-
-
-def format_date(dt: datetime) -> str:
+        day = min(day, days_in_month(year, month))
+    
+    return datetime(year, month, day)
+
+
+@lru_cache(maxsize=4096)
+def parse_iso_date(text: str) -> date:
+    """Разбирает дату YYYY-MM-DD из БД; одни и те же даты повторяются, поэтому кэшируем."""
+    return date.fromisoformat(text)
+
+
+@lru_cache(maxsize=4096)
+def format_date(dt: date) -> str:
     """Форматирует дату для отображения."""
     return dt.strftime("%d.%m.%Y")
 
 
+@lru_cache(maxsize=4096)
+def format_iso_date(text: str) -> str:
+    """
+    Дата YYYY-MM-DD из БД сразу в формат отображения.
+    Некорректная строка возвращается как есть (результат тоже кэшируется).
+    """
+    try:
+        return format_date(parse_iso_date(text))
+    except ValueError:
+        return text
+
+
+def when_text(days_left: int) -> str:
+    """Описание срока платежа для списка ближайших."""
+    if days_left == 0:
+        return "сегодня"
+    if days_left == 1:
+        return "завтра"
+    if days_left < 0:
+        return "просрочено"
+    return f"через {days_left} дн."
+
+
 # ─────────────────────────────────────────────────────────────
 # KEYBOARDS
 # ─────────────────────────────────────────────────────────────
+# Статические клавиатуры собираются один раз (объекты PTB неизменяемы);
+# инлайн-клавиатуры без аргументов и с sub_id кэшируются через lru_cache
+_MAIN_MENU_KEYBOARD = ReplyKeyboardMarkup([
+    ["📋 Мои подписки", "➕ Добавить"],
+    ["📅 Ближайшие", "📊 Статистика"],
+    ["⚙️ Настройки", "❓ Помощь"]
+], resize_keyboard=True)
+
+CANCEL_BUTTON_TEXT = "❌ Отмена"
+_CANCEL_KEYBOARD = ReplyKeyboardMarkup([[CANCEL_BUTTON_TEXT]], resize_keyboard=True)
+
+
 def main_menu_keyboard() -> ReplyKeyboardMarkup:
     """Главное меню бота."""
-    return ReplyKeyboardMarkup([
-        ["📋 Мои подписки", "➕ Добавить"],
-        ["📅 Ближайшие", "📊 Статистика"],
-        ["⚙️ Настройки", "❓ Помощь"]
-    ], resize_keyboard=True)
+    return _MAIN_MENU_KEYBOARD
 
 
 def cancel_keyboard() -> ReplyKeyboardMarkup:
     """Клавиатура с кнопкой отмены."""
-    return ReplyKeyboardMarkup([["❌ Отмена"]], resize_keyboard=True)
+    return _CANCEL_KEYBOARD
 
 
 def settings_keyboard(settings: Dict[str, Any]) -> InlineKeyboardMarkup:
@@ -665,22 +1138,28 @@ def settings_keyboard(settings: Dict[str, Any]) -> InlineKeyboardMarkup:
     ])
 
 
+def _grid_keyboard(buttons: List[InlineKeyboardButton], per_row: int,
+                   back: InlineKeyboardButton) -> InlineKeyboardMarkup:
+    """Раскладывает кнопки по строкам фиксированной ширины и добавляет «Назад»."""
+    rows = [buttons[i:i + per_row] for i in range(0, len(buttons), per_row)]
+    rows.append([back])
+    return InlineKeyboardMarkup(rows)
+
+
+@lru_cache(maxsize=1)
 def currency_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора валюты."""
-    buttons = []
-    row = []
-    for cur in ["NOK", "EUR", "USD", "RUB", "SEK", "DKK", "GBP"]:
-        symbol = CURRENCY_SYMBOL.get(cur, cur)
-        row.append(InlineKeyboardButton(f"{cur} {symbol}", callback_data=f"set_currency:{cur}"))
-        if len(row) == 3:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton("◀️ Назад", callback_data="settings:back")])
-    return InlineKeyboardMarkup(buttons)
+    return _grid_keyboard(
+        [
+            InlineKeyboardButton(f"{cur} {CURRENCY_SYMBOL.get(cur, cur)}", callback_data=f"set_currency:{cur}")
+            for cur in ["NOK", "EUR", "USD", "RUB", "SEK", "DKK", "GBP"]
+        ],
+        3,
+        InlineKeyboardButton("◀️ Назад", callback_data="settings:back"),
+    )
 
 
+@lru_cache(maxsize=1)
 def reminder_days_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора дней напоминаний."""
     return InlineKeyboardMarkup([
@@ -692,21 +1171,20 @@ def reminder_days_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
+@lru_cache(maxsize=1)
 def reminder_hour_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора часа напоминаний."""
-    buttons = []
-    row = []
-    for h in [7, 8, 9, 10, 12, 14, 18, 20, 21]:
-        row.append(InlineKeyboardButton(f"{h}:00", callback_data=f"set_hour:{h}"))
-        if len(row) == 3:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton("◀️ Назад", callback_data="settings:back")])
-    return InlineKeyboardMarkup(buttons)
+    return _grid_keyboard(
+        [
+            InlineKeyboardButton(f"{h}:00", callback_data=f"set_hour:{h}")
+            for h in [7, 8, 9, 10, 12, 14, 18, 20, 21]
+        ],
+        3,
+        InlineKeyboardButton("◀️ Назад", callback_data="settings:back"),
+    )
 
 
+@lru_cache(maxsize=256)
 def period_keyboard(sub_id: int) -> InlineKeyboardMarkup:
     """Клавиатура выбора периода подписки (после создания)."""
     return InlineKeyboardMarkup([
@@ -719,6 +1197,7 @@ def period_keyboard(sub_id: int) -> InlineKeyboardMarkup:
     ])
 
 
+@lru_cache(maxsize=1)
 def add_period_keyboard() -> InlineKeyboardMarkup:
     """Клавиатура выбора периода при добавлении подписки."""
     return InlineKeyboardMarkup([
@@ -732,11 +1211,12 @@ def add_period_keyboard() -> InlineKeyboardMarkup:
     ])
 
 
+@lru_cache(maxsize=256)
 def delete_confirm_keyboard(sub_id: int) -> InlineKeyboardMarkup:
     """Клавиатура подтверждения удаления."""
     return InlineKeyboardMarkup([[
         InlineKeyboardButton("✅ Да, удалить", callback_data=f"delete_confirm:{sub_id}"),
-        InlineKeyboardButton("❌ Отмена", callback_data=f"delete_cancel:{sub_id}")
+        InlineKeyboardButton(CANCEL_BUTTON_TEXT, callback_data=f"delete_cancel:{sub_id}")
     ]])
 
 
@@ -749,7 +1229,7 @@ def duplicate_keyboard(existing_id: int, temp_data_id: int) -> InlineKeyboardMar
         [InlineKeyboardButton("💰 Записать платёж", callback_data=f"dup_payment:{existing_id}:{temp_data_id}")],
         [InlineKeyboardButton("🔄 Обновить данные", callback_data=f"dup_update:{existing_id}:{temp_data_id}")],
         [InlineKeyboardButton("➕ Создать новую", callback_data=f"dup_create:{temp_data_id}")],
-        [InlineKeyboardButton("❌ Отмена", callback_data=f"dup_cancel:{temp_data_id}")]
+        [InlineKeyboardButton(CANCEL_BUTTON_TEXT, callback_data=f"dup_cancel:{temp_data_id}")]
     ])
 
 
@@ -794,34 +1274,33 @@ def edit_subscription_keyboard(sub_id: int) -> InlineKeyboardMarkup:
 
 def category_keyboard(sub_id: int) -> InlineKeyboardMarkup:
     """Клавиатура выбора категории."""
-    buttons = []
-    row = []
-    for cat in CATEGORIES:
-        row.append(InlineKeyboardButton(cat, callback_data=f"set_category:{sub_id}:{cat}"))
-        if len(row) == 2:
-            buttons.append(row)
-            row = []
-    if row:
-        buttons.append(row)
-    buttons.append([InlineKeyboardButton("◀️ Назад", callback_data=f"edit:{sub_id}")])
-    return InlineKeyboardMarkup(buttons)
+    return _grid_keyboard(
+        [InlineKeyboardButton(cat, callback_data=f"set_category:{sub_id}:{cat}") for cat in CATEGORIES],
+        2,
+        InlineKeyboardButton("◀️ Назад", callback_data=f"edit:{sub_id}"),
+    )
 
 
 # ─────────────────────────────────────────────────────────────
 # QUICK ADD PARSER
 # ─────────────────────────────────────────────────────────────
+_QUICK_ADD_DATE_RE = re.compile(r"(\d{1,2}[./]\d{1,2}[./]\d{2,4})$")
+_HAS_DIGIT_RE = re.compile(r"\d")
+
+
 def try_parse_quick_add(text: str) -> Optional[Dict[str, Any]]:
     """
     Парсит быстрое добавление подписки.
     Формат: "Netflix 129 kr 15.01.26"
     """
     text = text.strip()
-    if not text:
+    # Сумма обязательна, поэтому текст без цифр («привет», «ок») отсекаем
+    # одним проходом regex, не доходя до split и разбора токенов
+    if not _HAS_DIGIT_RE.search(text):
         return None
     
     # Ищем дату в конце
-    date_pattern = r"(\d{1,2}[./]\d{1,2}[./]\d{2,4})$"
-    date_match = re.search(date_pattern, text)
+    date_match = _QUICK_ADD_DATE_RE.search(text)
     date_str = None
     if date_match:
         date_str = date_match.group(1)
@@ -833,30 +1312,25 @@ def try_parse_quick_add(text: str) -> Optional[Dict[str, Any]]:
     
     name_parts = []
     amount = None
-    currency = DEFAULT_CURRENCY
-    
-    i = len(parts) - 1
-    while i >= 0:
-        part = parts[i]
-        if is_currency_token(part) and amount is None:
-            currency = normalize_currency_token(part)
-            i -= 1
-            continue
-        try:
-            num = float(part.replace(",", "."))
-            if 0 < num <= MAX_PRICE and amount is None:
-                amount = num
-                i -= 1
+    currency = None  # None — валюта не указана, берётся из настроек пользователя
+    
+    # Идём справа налево: валюта и сумма берутся только до первой найденной суммы,
+    # всё остальное — название (собираем в обратном порядке)
+    for part in reversed(parts):
+        if amount is None:
+            token_currency = normalize_currency_token(part)
+            if token_currency:
+                currency = token_currency
                 continue
-        except ValueError:
-            pass
-        name_parts.insert(0, part)
-        i -= 1
+            amount = _parse_amount(part)
+            if amount is not None:
+                continue
+        name_parts.append(part)
     
     if not name_parts or amount is None:
         return None
     
-    name = " ".join(name_parts)
+    name = " ".join(reversed(name_parts))
     date_obj = parse_date(date_str) if date_str else None
     
     return {"name": name, "amount": amount, "currency": currency, "date": date_obj}
@@ -868,35 +1342,68 @@ def try_parse_quick_add(text: str) -> Optional[Dict[str, Any]]:
 ADD_NAME, ADD_PRICE, ADD_DATE, ADD_PERIOD = range(4)
 EDIT_PRICE, EDIT_NAME = range(10, 12)
 
+# Шаблоны фильтров и callback-хендлеров компилируются один раз при импорте
+ADD_BUTTON_RE = re.compile(r"^➕ Добавить$")
+CANCEL_BUTTON_RE = re.compile(f"^{re.escape(CANCEL_BUTTON_TEXT)}$")
+ADD_PERIOD_CALLBACK_RE = re.compile(r"^add_period:")
+# set_category: относится к карточке подписки и обрабатывается в callback_router
+SETTINGS_CALLBACK_RE = re.compile(r"^(settings:|set_(currency|days|hour):)")
+DUPLICATE_CALLBACK_RE = re.compile(r"^dup_")
+
+# Повторяющиеся тексты ответов
+QUICK_ADD_EXAMPLE_MD = "`Netflix 129 kr 15\\.01\\.26`"
+SETTINGS_TEXT = "⚙️ *Настройки*\n\nВыбери что хочешь изменить:"
+PRICE_PARSE_ERROR_TEXT = "❌ Не понял цену. Введи число и валюту:\n129 kr, 9.99 EUR, 100"
+STALE_TEMP_DATA_TEXT = "❌ Данные устарели. Попробуйте снова."
+LIMIT_REACHED_TEXT = f"❌ Достигнут лимит: {MAX_SUBSCRIPTIONS_PER_USER} подписок."
+CANCELLED_TEXT = "Отменено 👌"
+SUB_NOT_FOUND_TEXT = "❌ Подписка не найдена."
+NAME_TOO_LONG_TEXT = f"❌ Слишком длинное название (макс. {MAX_NAME_LENGTH} символов)"
+PERIOD_CHOICE_HINT_MD = (
+    "• *Ежемесячная* — списание каждый месяц\n"
+    "• *Годовая* — списание раз в год\n"
+    "• *Еженедельная* — списание каждую неделю"
+)
+
+
+# Статичная часть приветствия; от пользователя зависит только имя
+START_BODY_MD = (
+    "Я помогу отслеживать твои подписки\\.\n\n"
+    "Используй кнопки меню или просто напиши:\n"
+    f"📝 {QUICK_ADD_EXAMPLE_MD}\n\n"
+    "И я добавлю подписку\\!"
+)
+
 
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /start."""
     user = update.effective_user
     await update.message.reply_text(
-        f"Привет, {escape_md(user.first_name)}\\! 👋\n\n"
-        "Я помогу отслеживать твои подписки\\.\n\n"
-        "Используй кнопки меню или просто напиши:\n"
-        "📝 `Netflix 129 kr 15\\.01\\.26`\n\n"
-        "И я добавлю подписку\\!",
+        f"Привет, {escape_md(user.first_name)}\\! 👋\n\n{START_BODY_MD}",
         parse_mode="MarkdownV2",
         reply_markup=main_menu_keyboard()
     )
 
 
+HELP_TEXT = (
+    "📖 *Как пользоваться ботом*\n\n"
+    "*Быстрое добавление:*\n"
+    "Просто напиши название, цену и дату:\n"
+    f"{QUICK_ADD_EXAMPLE_MD}\n\n"
+    "*Команды:*\n"
+    "/add — добавить подписку\n"
+    "/list — список подписок\n"
+    "/next — ближайшие платежи\n"
+    "/stats — статистика расходов\n"
+    "/settings — настройки\n"
+    "/help — эта справка"
+)
+
+
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /help."""
     await update.message.reply_text(
-        "📖 *Как пользоваться ботом*\n\n"
-        "*Быстрое добавление:*\n"
-        "Просто напиши название, цену и дату:\n"
-        "`Netflix 129 kr 15\\.01\\.26`\n\n"
-        "*Команды:*\n"
-        "/add — добавить подписку\n"
-        "/list — список подписок\n"
-        "/next — ближайшие платежи\n"
-        "/stats — статистика расходов\n"
-        "/settings — настройки\n"
-        "/help — эта справка",
+        HELP_TEXT,
         parse_mode="MarkdownV2",
         reply_markup=main_menu_keyboard()
     )
@@ -905,7 +1412,7 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Обработчик отмены."""
     context.user_data.clear()
-    await update.message.reply_text("Отменено 👌", reply_markup=main_menu_keyboard())
+    await update.message.reply_text(CANCELLED_TEXT, reply_markup=main_menu_keyboard())
     return ConversationHandler.END
 
 
@@ -915,11 +1422,10 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
 async def settings_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик команды /settings."""
     user_id = update.effective_user.id
-    settings = get_user_settings(user_id)
+    settings = await run_db(get_user_settings, user_id)
     
     await update.message.reply_text(
-        "⚙️ *Настройки*\n\n"
-        "Выбери что хочешь изменить:",
+        SETTINGS_TEXT,
         parse_mode="Markdown",
         reply_markup=settings_keyboard(settings)
     )
@@ -941,13 +1447,12 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
     
     elif data == "settings:reminder_toggle":
-        settings = get_user_settings(user_id)
+        settings = await run_db(get_user_settings, user_id)
         new_value = 0 if settings["reminder_enabled"] else 1
-        save_user_setting(user_id, "reminder_enabled", new_value)
-        settings = get_user_settings(user_id)
+        await run_db(save_user_setting, user_id, "reminder_enabled", new_value)
+        settings = await run_db(get_user_settings, user_id)
         await query.edit_message_text(
-            "⚙️ *Настройки*\n\n"
-            "Выбери что хочешь изменить:",
+            SETTINGS_TEXT,
             parse_mode="Markdown",
             reply_markup=settings_keyboard(settings)
         )
@@ -967,10 +1472,9 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         )
     
     elif data == "settings:back":
-        settings = get_user_settings(user_id)
+        settings = await run_db(get_user_settings, user_id)
         await query.edit_message_text(
-            "⚙️ *Настройки*\n\n"
-            "Выбери что хочешь изменить:",
+            SETTINGS_TEXT,
             parse_mode="Markdown",
             reply_markup=settings_keyboard(settings)
         )
@@ -979,10 +1483,10 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
         await query.edit_message_text("✅ Настройки сохранены!")
     
     elif data.startswith("set_currency:"):
-        currency = data.split(":")[1]
+        currency = data.partition(":")[2]
         if currency in SUPPORTED_CURRENCIES:
-            save_user_setting(user_id, "default_currency", currency)
-            settings = get_user_settings(user_id)
+            await run_db(save_user_setting, user_id, "default_currency", currency)
+            settings = await run_db(get_user_settings, user_id)
             await query.edit_message_text(
                 f"✅ Валюта изменена на *{currency}*\n\n"
                 "⚙️ *Настройки*",
@@ -991,9 +1495,9 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
             )
     
     elif data.startswith("set_days:"):
-        days = data.split(":")[1]
-        save_user_setting(user_id, "reminder_days", days)
-        settings = get_user_settings(user_id)
+        days = data.partition(":")[2]
+        await run_db(save_user_setting, user_id, "reminder_days", days)
+        settings = await run_db(get_user_settings, user_id)
         await query.edit_message_text(
             f"✅ Напоминания за *{days}* дн.\n\n"
             "⚙️ *Настройки*",
@@ -1003,10 +1507,10 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     elif data.startswith("set_hour:"):
         try:
-            hour = int(data.split(":")[1])
+            hour = int(data.partition(":")[2])
             if 0 <= hour <= 23:
-                save_user_setting(user_id, "reminder_hour", hour)
-                settings = get_user_settings(user_id)
+                await run_db(save_user_setting, user_id, "reminder_hour", hour)
+                settings = await run_db(get_user_settings, user_id)
                 await query.edit_message_text(
                     f"✅ Время напоминаний: *{hour}:00*\n\n"
                     "⚙️ *Настройки*",
@@ -1023,11 +1527,8 @@ async def settings_callback(update: Update, context: ContextTypes.DEFAULT_TYPE)
 async def add_start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int:
     """Начало добавления подписки."""
     user_id = update.effective_user.id
-    if count_user_subscriptions(user_id) >= MAX_SUBSCRIPTIONS_PER_USER:
-        await update.message.reply_text(
-            f"❌ Достигнут лимит: {MAX_SUBSCRIPTIONS_PER_USER} подписок.",
-            reply_markup=main_menu_keyboard()
-        )
+    if await run_db(count_user_subscriptions, user_id) >= MAX_SUBSCRIPTIONS_PER_USER:
+        await update.message.reply_text(LIMIT_REACHED_TEXT, reply_markup=main_menu_keyboard())
         return ConversationHandler.END
     
     await update.message.reply_text(
@@ -1046,7 +1547,7 @@ async def add_flow_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     user_id = update.effective_user.id
     
     # Проверка на отмену
-    if text == "❌ Отмена":
+    if text == CANCEL_BUTTON_TEXT:
         return await cancel(update, context)
     
     # Попытка быстрого добавления
@@ -1056,7 +1557,7 @@ async def add_flow_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     
     if len(text) > MAX_NAME_LENGTH:
         await update.message.reply_text(
-            f"❌ Слишком длинное название (макс. {MAX_NAME_LENGTH} символов)",
+            NAME_TOO_LONG_TEXT,
             reply_markup=cancel_keyboard()
         )
         return ADD_NAME
@@ -1064,7 +1565,7 @@ async def add_flow_name(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     context.user_data["add_name"] = text
     
     # Получаем валюту пользователя
-    settings = get_user_settings(user_id)
+    settings = await run_db(get_user_settings, user_id)
     currency = settings["currency"]
     symbol = CURRENCY_SYMBOL.get(currency, currency)
     
@@ -1080,26 +1581,22 @@ async def add_flow_price(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     text = update.message.text.strip()
     user_id = update.effective_user.id
     
-    if text == "❌ Отмена":
+    if text == CANCEL_BUTTON_TEXT:
         return await cancel(update, context)
     
-    settings = get_user_settings(user_id)
-    
     parsed = parse_price(text)
     if not parsed:
         await update.message.reply_text(
-            "❌ Не понял цену. Введи число и валюту:\n129 kr, 9.99 EUR, 100",
+            PRICE_PARSE_ERROR_TEXT,
             reply_markup=cancel_keyboard()
         )
         return ADD_PRICE
     
     amount, currency = parsed
-    # Если валюта по умолчанию (не указана явно), используем настройки пользователя
-    if currency == DEFAULT_CURRENCY:
-        # Проверяем, была ли валюта указана в вводе
-        has_currency_in_input = any(is_currency_token(p) for p in text.split())
-        if not has_currency_in_input:
-            currency = settings["currency"]
+    # Валюта не указана — берём из настроек пользователя
+    if currency is None:
+        settings = await run_db(get_user_settings, user_id)
+        currency = settings["currency"]
     
     context.user_data["add_amount"] = amount
     context.user_data["add_currency"] = currency
@@ -1116,7 +1613,7 @@ async def add_flow_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     text = update.message.text.strip()
     user_id = update.effective_user.id
     
-    if text == "❌ Отмена":
+    if text == CANCEL_BUTTON_TEXT:
         return await cancel(update, context)
     
     date_obj = parse_date(text)
@@ -1132,13 +1629,13 @@ async def add_flow_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     currency = context.user_data.get("add_currency", DEFAULT_CURRENCY)
     
     # Проверка на дубликат
-    existing = find_duplicate_subscription(user_id, name)
+    existing = await run_db(find_duplicate_subscription, user_id, name)
     if existing:
         # Сохраняем данные во временную таблицу
         temp_data = f"{name}|{amount}|{currency}|{date_obj.isoformat()}"
-        temp_id = save_temp_data(user_id, "duplicate_add", temp_data)
+        temp_id = await run_db(save_temp_data, user_id, "duplicate_add", temp_data)
         
-        ex_amount, ex_cur = unpack_price(existing["price"])
+        ex_amount, ex_cur = existing["amount"], existing["currency"]
         await update.message.reply_text(
             f"⚠️ Подписка *{escape_md(existing['name'])}* уже существует\\!\n"
             f"Текущая цена: {escape_md(format_price(ex_amount, ex_cur))}\n\nЧто сделать?",
@@ -1163,9 +1660,7 @@ async def add_flow_date(update: Update, context: ContextTypes.DEFAULT_TYPE) -> i
     
     await update.message.reply_text(
         f"📅 *Выбери тип подписки:*\n\n"
-        f"• *Ежемесячная* — списание каждый месяц\n"
-        f"• *Годовая* — списание раз в год\n"
-        f"• *Еженедельная* — списание каждую неделю",
+        f"{PERIOD_CHOICE_HINT_MD}",
         parse_mode="MarkdownV2",
         reply_markup=add_period_keyboard()
     )
@@ -1183,8 +1678,8 @@ async def add_flow_period_callback(update: Update, context: ContextTypes.DEFAULT
     if not data.startswith("add_period:"):
         return ADD_PERIOD
     
-    period = data.split(":")[1]
-    if period not in ("month", "year", "week"):
+    period = data.partition(":")[2]
+    if period not in SUPPORTED_PERIODS:
         return ADD_PERIOD
     
     # Получаем данные из контекста
@@ -1203,21 +1698,19 @@ async def add_flow_period_callback(update: Update, context: ContextTypes.DEFAULT
     next_dt = next_from_last(date_obj, period)
     price = pack_price(amount, currency)
     
-    new_id = add_subscription(
+    new_id = await run_db(
+        add_subscription_with_payment,
         user_id=user_id, name=name, price=price,
         next_date=next_dt.strftime("%Y-%m-%d"),
         period=period,
         last_charge_date=date_obj.strftime("%Y-%m-%d"),
         category=category
     )
-    add_payment(user_id, new_id, price, date_obj.strftime("%Y-%m-%d"))
-    
-    period_names = {"month": "ежемесячная", "year": "годовая", "week": "еженедельная"}
     
     await query.edit_message_text(
         f"✅ Добавлено: *{escape_md(name)}*\n"
         f"💰 {escape_md(format_price(amount, currency))}\n"
-        f"📅 Тип: {period_names.get(period, period)}\n"
+        f"📅 Тип: {PERIOD_NAMES_ADJ.get(period, period)}\n"
         f"📅 Следующий платёж: {escape_md(format_date(next_dt))}\n"
         f"🏷 Категория: {escape_md(category)}",
         parse_mode="MarkdownV2"
@@ -1236,17 +1729,20 @@ async def process_quick_add(update: Update, context: ContextTypes.DEFAULT_TYPE,
     date_obj = quick["date"]
     
     # Если валюта не указана, используем настройки пользователя
-    if currency == DEFAULT_CURRENCY and not any(is_currency_token(p) for p in quick["name"].split()):
-        settings = get_user_settings(user_id)
+    if currency is None:
+        settings = await run_db(get_user_settings, user_id)
         currency = settings["currency"]
     
-    # Проверка на дубликат
-    existing = find_duplicate_subscription(user_id, name)
+    # Проверка на дубликат (menu_router мог уже найти его вместе с подсчётом лимита)
+    if "existing" in quick:
+        existing = quick["existing"]
+    else:
+        existing = await run_db(find_duplicate_subscription, user_id, name)
     if existing:
         temp_data = f"{name}|{amount}|{currency}|{date_obj.isoformat() if date_obj else ''}"
-        temp_id = save_temp_data(user_id, "duplicate_add", temp_data)
+        temp_id = await run_db(save_temp_data, user_id, "duplicate_add", temp_data)
         
-        ex_amount, ex_cur = unpack_price(existing["price"])
+        ex_amount, ex_cur = existing["amount"], existing["currency"]
         await update.message.reply_text(
             f"⚠️ Подписка *{escape_md(existing['name'])}* уже существует\\!\n"
             f"Текущая цена: {escape_md(format_price(ex_amount, ex_cur))}\n\nЧто сделать?",
@@ -1272,9 +1768,7 @@ async def process_quick_add(update: Update, context: ContextTypes.DEFAULT_TYPE,
     
     await update.message.reply_text(
         f"📅 *Выбери тип подписки для {escape_md(name)}:*\n\n"
-        f"• *Ежемесячная* — списание каждый месяц\n"
-        f"• *Годовая* — списание раз в год\n"
-        f"• *Еженедельная* — списание каждую неделю",
+        f"{PERIOD_CHOICE_HINT_MD}",
         parse_mode="MarkdownV2",
         reply_markup=add_period_keyboard()
     )
@@ -1284,38 +1778,37 @@ async def process_quick_add(update: Update, context: ContextTypes.DEFAULT_TYPE,
 # ─────────────────────────────────────────────────────────────
 # LIST / NEXT / STATS
 # ─────────────────────────────────────────────────────────────
+def format_subscription_card(sub: Mapping[str, Any]) -> str:
+    """Карточка подписки в MarkdownV2 (список и возврат из редактирования)."""
+    status = "⏸ " if sub["is_paused"] else ""
+    period_text = PERIOD_NAMES_SHORT.get(sub["period"], sub["period"])
+    date_text = format_iso_date(sub["next_date"])
+    
+    return (
+        f"{status}*{escape_md(sub['name'])}*\n"
+        f"💰 {escape_md(format_price(sub['amount'], sub['currency']))} / {escape_md(period_text)}\n"
+        f"📅 Следующий: {escape_md(date_text)}\n"
+        f"🏷 {escape_md(sub['category'])}"
+    )
+
+
 async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает список подписок."""
     user_id = update.effective_user.id
-    subs = list_subscriptions(user_id)
+    subs = await run_db(list_subscriptions, user_id)
     
     if not subs:
         await update.message.reply_text(
-            "📋 У тебя пока нет подписок\\.\n\nНапиши:\n`Netflix 129 kr 15\\.01\\.26`",
+            f"📋 У тебя пока нет подписок\\.\n\nНапиши:\n{QUICK_ADD_EXAMPLE_MD}",
             parse_mode="MarkdownV2",
             reply_markup=main_menu_keyboard()
         )
         return
     
+    reply = update.message.reply_text
     for sub in subs:
-        amount, currency = unpack_price(sub["price"])
-        price_view = format_price(amount, currency)
-        status = "⏸ " if sub["is_paused"] else ""
-        
-        period_names = {"month": "мес", "year": "год", "week": "нед"}
-        period_text = period_names.get(sub["period"], sub["period"])
-        
-        try:
-            dt = datetime.strptime(sub["next_date"], "%Y-%m-%d")
-            date_text = format_date(dt)
-        except ValueError:
-            date_text = sub["next_date"]
-        
-        await update.message.reply_text(
-            f"{status}*{escape_md(sub['name'])}*\n"
-            f"💰 {escape_md(price_view)} / {escape_md(period_text)}\n"
-            f"📅 Следующий: {escape_md(date_text)}\n"
-            f"🏷 {escape_md(sub['category'])}",
+        await reply(
+            format_subscription_card(sub),
             parse_mode="MarkdownV2",
             reply_markup=subscription_keyboard(sub["id"], sub["is_paused"])
         )
@@ -1324,51 +1817,43 @@ async def list_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def next_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Показывает ближайшие платежи."""
     user_id = update.effective_user.id
-    subs = list_subscriptions(user_id)
-    
-    if not subs:
-        await update.message.reply_text("📅 Нет подписок.", reply_markup=main_menu_keyboard())
-        return
-    
     today = datetime.now().date()
+    until = today + timedelta(days=UPCOMING_DAYS)
+    
+    # Фильтр по сроку и сортировка выполняются в SQL по индексу (user_id, next_date)
+    subs = await run_db(list_upcoming_subscriptions, user_id, until.isoformat())
+    today_ord = today.toordinal()
     upcoming = []
+    append = upcoming.append
     
     for sub in subs:
-        if sub["is_paused"]:
-            continue
         try:
-            dt = datetime.strptime(sub["next_date"], "%Y-%m-%d").date()
-            days_left = (dt - today).days
-            if days_left <= 30:
-                amount, currency = unpack_price(sub["price"])
-                upcoming.append((days_left, dt, sub["name"], amount, currency))
+            dt = parse_iso_date(sub["next_date"])
         except ValueError:
             continue
+        amount, currency = sub["amount"], sub["currency"]
+        append((dt.toordinal() - today_ord, dt, sub["name"], amount, currency))
     
     if not upcoming:
-        await update.message.reply_text(
-            "📅 В ближайшие 30 дней платежей нет.", 
-            reply_markup=main_menu_keyboard()
-        )
+        if not await run_db(count_user_subscriptions, user_id):
+            await update.message.reply_text("📅 Нет подписок.", reply_markup=main_menu_keyboard())
+        else:
+            await update.message.reply_text(
+                f"📅 В ближайшие {UPCOMING_DAYS} дней платежей нет.", 
+                reply_markup=main_menu_keyboard()
+            )
         return
     
-    upcoming.sort(key=lambda x: x[0])
     lines = ["📅 *Ближайшие платежи:*\n"]
-    
     for days_left, dt, name, amount, currency in upcoming:
-        price_view = format_price(amount, currency)
-        if days_left == 0:
-            when = "сегодня"
-        elif days_left == 1:
-            when = "завтра"
-        elif days_left < 0:
-            when = "просрочено"
-        else:
-            when = f"через {days_left} дн."
-        lines.append(f"• *{escape_md(name)}* — {escape_md(price_view)}\n  {dt.strftime('%d.%m.%Y')} \\({escape_md(when)}\\)")
+        lines.append(
+            f"• *{escape_md(name)}* — {escape_md(format_price(amount, currency))}\n"
+            f"  {escape_md(format_date(dt))} \\({escape_md(when_text(days_left))}\\)"
+        )
+    text = "\n".join(lines)
     
     await update.message.reply_text(
-        "\n".join(lines), 
+        text, 
         parse_mode="MarkdownV2", 
         reply_markup=main_menu_keyboard()
     )
@@ -1381,58 +1866,43 @@ async def stats_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await show_stats_for_year(update, user_id, year)
 
 
+# Индекс — номер месяца (1–12)
+MONTH_NAMES_SHORT = ("", "янв", "фев", "мар", "апр", "май", "июн",
+                     "июл", "авг", "сен", "окт", "ноя", "дек")
+
+# Символы, которые могут встретиться в тексте статистики вне разметки
+_STATS_MD_ESCAPE = str.maketrans({".": "\\.", "-": "\\-", "!": "\\!"})
+
+
 async def show_stats_for_year(update: Update, user_id: int, year: int, edit: bool = False) -> None:
     """Показывает статистику за год с группировкой по валютам."""
-    payments = get_payments_for_year(user_id, year)
+    rows = await run_db(get_year_stats, user_id, year)
     
-    # Группировка по валютам и месяцам
-    stats_by_currency: Dict[str, Dict[int, float]] = {}
-    totals_by_currency: Dict[str, float] = {}
-    
-    for payment in payments:
-        amount, currency = unpack_price(payment["amount"])
-        try:
-            dt = datetime.strptime(payment["paid_at"], "%Y-%m-%d")
-            month = dt.month
-            
-            if currency not in stats_by_currency:
-                stats_by_currency[currency] = {}
-                totals_by_currency[currency] = 0.0
-            
-            if month not in stats_by_currency[currency]:
-                stats_by_currency[currency][month] = 0.0
-            
-            stats_by_currency[currency][month] += amount
-            totals_by_currency[currency] += amount
-        except ValueError:
-            continue
-    
-    month_names = ["", "янв", "фев", "мар", "апр", "май", "июн", 
-                   "июл", "авг", "сен", "окт", "ноя", "дек"]
+    # Суммы по месяцам уже посчитаны в SQL; здесь только раскладываем по валютам
+    stats_by_currency: Dict[str, Dict[int, float]] = defaultdict(dict)
+    for currency, month, amount in rows:
+        stats_by_currency[currency][month] = amount
     
     lines = [f"📊 *Статистика за {year} год:*\n"]
     
     if stats_by_currency:
-        for currency in sorted(stats_by_currency.keys()):
-            months = stats_by_currency[currency]
-            total = totals_by_currency[currency]
+        for currency, months in stats_by_currency.items():
+            total = sum(months.values())
             symbol = CURRENCY_SYMBOL.get(currency, currency)
             
             lines.append(f"\n*{currency}:*")
-            for m in sorted(months.keys()):
-                formatted = f"{months[m]:,.0f}".replace(",", " ")
-                lines.append(f"{month_names[m]}: {formatted} {symbol}")
-            
-            total_formatted = f"{total:,.0f}".replace(",", " ")
-            lines.append(f"*Итого: {total_formatted} {symbol}*")
+            lines.extend(
+                f"{MONTH_NAMES_SHORT[m]}: {format_whole_amount(month_total)} {symbol}"
+                for m, month_total in months.items()
+            )
+            lines.append(f"*Итого: {format_whole_amount(total)} {symbol}*")
     else:
         lines.append("Нет данных о платежах.")
     
-    text = "\n".join(lines)
     keyboard = year_keyboard(year)
     
-    # Экранируем для MarkdownV2
-    text_escaped = text.replace(".", "\\.").replace("-", "\\-").replace("!", "\\!")
+    # Склеиваем и экранируем для MarkdownV2 за один проход по тексту
+    text_escaped = "\n".join(lines).translate(_STATS_MD_ESCAPE)
     
     if edit and update.callback_query:
         await update.callback_query.edit_message_text(
@@ -1451,458 +1921,439 @@ async def show_stats_for_year(update: Update, user_id: int, year: int, edit: boo
 # ─────────────────────────────────────────────────────────────
 # CALLBACK HANDLERS
 # ─────────────────────────────────────────────────────────────
+async def _cb_stats_year(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Статистика по годам."""
+    year = int(rest)
+    await show_stats_for_year(update, user_id, year, edit=True)
+
+
+async def _cb_delete_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Подтверждение удаления."""
+    query = update.callback_query
+    sub_id = int(rest)
+    if await run_db(delete_subscription, sub_id, user_id):
+        await query.edit_message_text("🗑 Подписка удалена.")
+    else:
+        await query.edit_message_text("❌ Не удалось удалить подписку.")
+
+
+async def _cb_delete_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Отмена удаления."""
+    query = update.callback_query
+    await query.edit_message_text(CANCELLED_TEXT)
+
+
+async def _cb_delete(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Запрос подтверждения удаления."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        await query.edit_message_text(
+            f"Удалить подписку *{escape_md(sub['name'])}*?",
+            parse_mode="MarkdownV2",
+            reply_markup=delete_confirm_keyboard(sub_id)
+        )
+
+
+async def _cb_pause(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Пауза и возобновление подписки."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(toggle_subscription_pause, sub_id, user_id)
+    if sub:
+        status = "приостановлена ⏸" if sub["is_paused"] else "возобновлена ▶️"
+        await query.edit_message_text(
+            f"Подписка *{escape_md(sub['name'])}* {status}", 
+            parse_mode="MarkdownV2"
+        )
+
+
+async def _cb_paid(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Отметка оплаты."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        today = datetime.now()
+        today_str = today.strftime("%Y-%m-%d")
+        new_next = next_from_last(today, sub["period"])
+
+        await run_db(record_subscription_payment, sub_id, user_id, {
+            "last_charge_date": today_str,
+            "next_date": new_next.strftime("%Y-%m-%d")
+        }, sub["price"], today_str)
+        amount, currency = sub["amount"], sub["currency"]
+
+        await query.edit_message_text(
+            f"✅ *{escape_md(sub['name'])}* — оплата записана\\!\n"
+            f"💰 {escape_md(format_price(amount, currency))}\n"
+            f"📅 Следующий платёж: {escape_md(format_date(new_next))}",
+            parse_mode="MarkdownV2"
+        )
+
+
+async def _cb_period(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Выбор периода (после добавления)."""
+    query = update.callback_query
+    sub_id_str, _, new_period = rest.partition(":")
+    sub_id = int(sub_id_str)
+
+    if new_period not in SUPPORTED_PERIODS:
+        return
+
+    sub = await run_db(set_subscription_period, sub_id, new_period, user_id)
+    if sub:
+        await query.edit_message_text(
+            f"✅ Период изменён на: *{PERIOD_NAMES.get(new_period, new_period)}*\n\n"
+            f"Подписка *{escape_md(sub['name'])}* сохранена\\!",
+            parse_mode="MarkdownV2"
+        )
+
+
+async def _cb_period_done(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Кнопка "Готово" после выбора периода."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        await query.edit_message_text(
+            f"✅ Подписка *{escape_md(sub['name'])}* сохранена\\!\n"
+            f"📅 Период: {PERIOD_NAMES.get(sub['period'], sub['period'])}",
+            parse_mode="MarkdownV2"
+        )
+
+
+async def _cb_change_period(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Изменить период (из списка подписок)."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        await query.edit_message_text(
+            f"📅 *Выбери период для {escape_md(sub['name'])}:*",
+            parse_mode="MarkdownV2",
+            reply_markup=period_keyboard(sub_id)
+        )
+
+
+async def _cb_edit(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Редактирование подписки."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        amount, currency = sub["amount"], sub["currency"]
+        await query.edit_message_text(
+            f"✏️ *Редактирование: {escape_md(sub['name'])}*\n\n"
+            f"💰 Цена: {escape_md(format_price(amount, currency))}\n"
+            f"📅 Период: {sub['period']}\n"
+            f"🏷 Категория: {escape_md(sub['category'])}\n\n"
+            f"Что изменить?",
+            parse_mode="MarkdownV2",
+            reply_markup=edit_subscription_keyboard(sub_id)
+        )
+
+
+async def _cb_edit_back(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Возврат к карточке подписки."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        await query.edit_message_text(
+            format_subscription_card(sub),
+            parse_mode="MarkdownV2",
+            reply_markup=subscription_keyboard(sub_id, sub["is_paused"])
+        )
+
+
+async def _cb_edit_category(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Редактирование категории."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        await query.edit_message_text(
+            f"🏷 *Выбери категорию для {escape_md(sub['name'])}:*",
+            parse_mode="MarkdownV2",
+            reply_markup=category_keyboard(sub_id)
+        )
+
+
+async def _cb_set_category(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Установка категории."""
+    query = update.callback_query
+    sub_id_str, _, new_category = rest.partition(":")
+    sub_id = int(sub_id_str)
+
+    if new_category not in CATEGORIES:
+        return
+
+    # UPDATE уже проверяет владельца, отдельный SELECT не нужен
+    if await run_db(update_subscription_field, sub_id, "category", new_category, user_id):
+        # Названия категорий без разметки, парсер Markdown не нужен
+        await query.edit_message_text(f"✅ Категория изменена на: {new_category}")
+
+
+async def _cb_edit_price(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Запрос на редактирование цены."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        context.user_data["edit_sub_id"] = sub_id
+        context.user_data["edit_field"] = "price"
+        await query.edit_message_text(
+            f"💰 Введи новую цену для *{escape_md(sub['name'])}*:\n\n"
+            f"Например: 129 kr, 9.99 EUR, 100\n\n"
+            f"Отправь /cancel для отмены",
+            parse_mode="MarkdownV2"
+        )
+
+
+async def _cb_edit_name(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Запрос на редактирование названия."""
+    query = update.callback_query
+    sub_id = int(rest)
+    sub = await run_db(get_subscription_if_owner, sub_id, user_id)
+    if sub:
+        context.user_data["edit_sub_id"] = sub_id
+        context.user_data["edit_field"] = "name"
+        await query.edit_message_text(
+            f"📝 Введи новое название для подписки:\n\n"
+            f"Текущее: {escape_md(sub['name'])}\n\n"
+            f"Отправь /cancel для отмены",
+            parse_mode="MarkdownV2"
+        )
+
+
+CALLBACK_HANDLERS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE, int, str], Awaitable[None]]] = {
+    "stats_year": _cb_stats_year,
+    "delete_confirm": _cb_delete_confirm,
+    "delete_cancel": _cb_delete_cancel,
+    "delete": _cb_delete,
+    "pause": _cb_pause,
+    "paid": _cb_paid,
+    "period": _cb_period,
+    "period_done": _cb_period_done,
+    "change_period": _cb_change_period,
+    "edit": _cb_edit,
+    "edit_back": _cb_edit_back,
+    "edit_category": _cb_edit_category,
+    "set_category": _cb_set_category,
+    "edit_price": _cb_edit_price,
+    "edit_name": _cb_edit_name,
+}
+
+
 async def callback_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Главный роутер callback-кнопок."""
     query = update.callback_query
     await query.answer()
     
-    data = query.data or ""
-    user_id = query.from_user.id
-    
-    # Статистика по годам
-    if data.startswith("stats_year:"):
-        try:
-            year = int(data.split(":")[1])
-            await show_stats_for_year(update, user_id, year, edit=True)
-        except (ValueError, IndexError):
-            pass
-        return
-    
-    # Подтверждение удаления
-    if data.startswith("delete_confirm:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            if delete_subscription(sub_id, user_id):
-                await query.edit_message_text("🗑 Подписка удалена.")
-            else:
-                await query.edit_message_text("❌ Не удалось удалить подписку.")
-        except (ValueError, IndexError):
-            pass
-        return
-    
-    if data.startswith("delete_cancel:"):
-        await query.edit_message_text("Отменено 👌")
-        return
-    
-    # Удаление
-    if data.startswith("delete:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                await query.edit_message_text(
-                    f"Удалить подписку *{escape_md(sub['name'])}*?",
-                    parse_mode="MarkdownV2",
-                    reply_markup=delete_confirm_keyboard(sub_id)
-                )
-        except (ValueError, IndexError):
-            pass
+    # Префикс до первого ":" выбирает обработчик, остаток передаётся ему как есть
+    prefix, _, rest = (query.data or "").partition(":")
+    handler = CALLBACK_HANDLERS.get(prefix)
+    if handler is None:
         return
-    
-    # Пауза
-    if data.startswith("pause:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                new_paused = 0 if sub["is_paused"] else 1
-                update_subscription_field(sub_id, "is_paused", new_paused, user_id)
-                status = "приостановлена ⏸" if new_paused else "возобновлена ▶️"
-                await query.edit_message_text(
-                    f"Подписка *{escape_md(sub['name'])}* {status}", 
-                    parse_mode="MarkdownV2"
-                )
-        except (ValueError, IndexError):
-            pass
-        return
-    
-    # Отметка оплаты
-    if data.startswith("paid:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                today = datetime.now()
-                today_str = today.strftime("%Y-%m-%d")
-                new_next = next_from_last(today, sub["period"])
-                
-                update_subscription_fields(sub_id, {
-                    "last_charge_date": today_str,
-                    "next_date": new_next.strftime("%Y-%m-%d")
-                }, user_id)
-                
-                add_payment(user_id, sub_id, sub["price"], today_str)
-                amount, currency = unpack_price(sub["price"])
-                
-                await query.edit_message_text(
-                    f"✅ *{escape_md(sub['name'])}* — оплата записана\\!\n"
-                    f"💰 {escape_md(format_price(amount, currency))}\n"
-                    f"📅 Следующий платёж: {escape_md(format_date(new_next))}",
-                    parse_mode="MarkdownV2"
-                )
-        except (ValueError, IndexError):
-            pass
+    try:
+        await handler(update, context, query.from_user.id, rest)
+    except (ValueError, IndexError):
+        pass
+
+
+async def _dup_payment(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Дубликат: записать платёж по существующей подписке."""
+    query = update.callback_query
+    existing_id_str, _, temp_id_str = rest.partition(":")
+    if not temp_id_str:
         return
-    
-    # Выбор периода (после добавления)
-    if data.startswith("period:"):
-        try:
-            parts = data.split(":")
-            sub_id = int(parts[1])
-            new_period = parts[2]
-            
-            if new_period not in ("month", "year", "week"):
-                return
-            
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                updates = {"period": new_period}
-                
-                if sub["last_charge_date"]:
-                    last_dt = datetime.strptime(sub["last_charge_date"], "%Y-%m-%d")
-                    new_next = next_from_last(last_dt, new_period)
-                    updates["next_date"] = new_next.strftime("%Y-%m-%d")
-                
-                update_subscription_fields(sub_id, updates, user_id)
-                
-                period_names = {"month": "месяц", "year": "год", "week": "неделя"}
-                await query.edit_message_text(
-                    f"✅ Период изменён на: *{period_names.get(new_period, new_period)}*\n\n"
-                    f"Подписка *{escape_md(sub['name'])}* сохранена\\!",
-                    parse_mode="MarkdownV2"
-                )
-        except (ValueError, IndexError):
-            pass
+    existing_id = int(existing_id_str)
+    temp_id = int(temp_id_str)
+
+    # Проверяем владельца подписки
+    sub = await run_db(get_subscription_if_owner, existing_id, user_id)
+    if not sub:
+        await query.edit_message_text(SUB_NOT_FOUND_TEXT)
         return
-    
-    # Кнопка "Готово" после выбора периода
-    if data.startswith("period_done:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                period_names = {"month": "месяц", "year": "год", "week": "неделя"}
-                await query.edit_message_text(
-                    f"✅ Подписка *{escape_md(sub['name'])}* сохранена\\!\n"
-                    f"📅 Период: {period_names.get(sub['period'], sub['period'])}",
-                    parse_mode="MarkdownV2"
-                )
-        except (ValueError, IndexError):
-            pass
+
+    # Получаем временные данные
+    temp_data = await run_db(get_temp_data, temp_id, user_id)
+    if not temp_data:
+        await query.edit_message_text(STALE_TEMP_DATA_TEXT)
         return
-    
-    # Изменить период (из списка подписок)
-    if data.startswith("change_period:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                await query.edit_message_text(
-                    f"📅 *Выбери период для {escape_md(sub['name'])}:*",
-                    parse_mode="MarkdownV2",
-                    reply_markup=period_keyboard(sub_id)
-                )
-        except (ValueError, IndexError):
-            pass
+
+    data_parts = temp_data.split("|")
+    if len(data_parts) < 4:
         return
-    
-    # Редактирование подписки
-    if data.startswith("edit:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                amount, currency = unpack_price(sub["price"])
-                await query.edit_message_text(
-                    f"✏️ *Редактирование: {escape_md(sub['name'])}*\n\n"
-                    f"💰 Цена: {escape_md(format_price(amount, currency))}\n"
-                    f"📅 Период: {sub['period']}\n"
-                    f"🏷 Категория: {escape_md(sub['category'])}\n\n"
-                    f"Что изменить?",
-                    parse_mode="MarkdownV2",
-                    reply_markup=edit_subscription_keyboard(sub_id)
-                )
-        except (ValueError, IndexError):
-            pass
+
+    name, amount_str, currency, date_str = data_parts
+    amount = float(amount_str)
+    price = pack_price(amount, currency)
+
+    if date_str:
+        last_dt = datetime.fromisoformat(date_str)
+        new_next = next_from_last(last_dt, sub["period"])
+
+        await run_db(record_subscription_payment, existing_id, user_id, {
+            "last_charge_date": last_dt.strftime("%Y-%m-%d"),
+            "price": price,
+            "next_date": new_next.strftime("%Y-%m-%d")
+        }, price, last_dt.strftime("%Y-%m-%d"))
+
+        # Ответ и удаление временных данных не зависят друг от друга
+        await asyncio.gather(
+            query.edit_message_text(
+                f"✅ Платёж записан\\!\n"
+                f"💰 {escape_md(format_price(amount, currency))}\n"
+                f"📅 {escape_md(format_date(last_dt))}",
+                parse_mode="MarkdownV2"
+            ),
+            run_db(delete_temp_data, temp_id),
+        )
+    else:
+        await run_db(delete_temp_data, temp_id)
+
+
+async def _dup_update(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Дубликат: обновить цену и даты существующей подписки."""
+    query = update.callback_query
+    existing_id_str, _, temp_id_str = rest.partition(":")
+    if not temp_id_str:
         return
-    
-    # Возврат к карточке подписки
-    if data.startswith("edit_back:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                amount, currency = unpack_price(sub["price"])
-                period_names = {"month": "мес", "year": "год", "week": "нед"}
-                
-                try:
-                    dt = datetime.strptime(sub["next_date"], "%Y-%m-%d")
-                    date_text = format_date(dt)
-                except ValueError:
-                    date_text = sub["next_date"]
-                
-                status = "⏸ " if sub["is_paused"] else ""
-                await query.edit_message_text(
-                    f"{status}*{escape_md(sub['name'])}*\n"
-                    f"💰 {escape_md(format_price(amount, currency))} / {period_names.get(sub['period'], sub['period'])}\n"
-                    f"📅 Следующий: {escape_md(date_text)}\n"
-                    f"🏷 {escape_md(sub['category'])}",
-                    parse_mode="MarkdownV2",
-                    reply_markup=subscription_keyboard(sub_id, sub["is_paused"])
-                )
-        except (ValueError, IndexError):
-            pass
+    existing_id = int(existing_id_str)
+    temp_id = int(temp_id_str)
+
+    sub = await run_db(get_subscription_if_owner, existing_id, user_id)
+    if not sub:
+        await query.edit_message_text(SUB_NOT_FOUND_TEXT)
         return
-    
-    # Редактирование категории
-    if data.startswith("edit_category:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                await query.edit_message_text(
-                    f"🏷 *Выбери категорию для {escape_md(sub['name'])}:*",
-                    parse_mode="MarkdownV2",
-                    reply_markup=category_keyboard(sub_id)
-                )
-        except (ValueError, IndexError):
-            pass
+
+    temp_data = await run_db(get_temp_data, temp_id, user_id)
+    if not temp_data:
+        await query.edit_message_text(STALE_TEMP_DATA_TEXT)
         return
-    
-    # Установка категории
-    if data.startswith("set_category:"):
-        try:
-            parts = data.split(":", 2)
-            sub_id = int(parts[1])
-            new_category = parts[2]
-            
-            if new_category not in CATEGORIES:
-                return
-            
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                update_subscription_field(sub_id, "category", new_category, user_id)
-                await query.edit_message_text(
-                    f"✅ Категория изменена на: {new_category}",
-                    parse_mode="Markdown"
-                )
-        except (ValueError, IndexError):
-            pass
+
+    data_parts = temp_data.split("|")
+    if len(data_parts) < 4:
         return
-    
-    # Запрос на редактирование цены
-    if data.startswith("edit_price:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                context.user_data["edit_sub_id"] = sub_id
-                context.user_data["edit_field"] = "price"
-                await query.edit_message_text(
-                    f"💰 Введи новую цену для *{escape_md(sub['name'])}*:\n\n"
-                    f"Например: 129 kr, 9.99 EUR, 100\n\n"
-                    f"Отправь /cancel для отмены",
-                    parse_mode="MarkdownV2"
-                )
-        except (ValueError, IndexError):
-            pass
+
+    name, amount_str, currency, date_str = data_parts
+    amount = float(amount_str)
+    price = pack_price(amount, currency)
+
+    updates = {"price": price}
+
+    if date_str:
+        last_dt = datetime.fromisoformat(date_str)
+        new_next = next_from_last(last_dt, sub["period"])
+        updates["last_charge_date"] = last_dt.strftime("%Y-%m-%d")
+        updates["next_date"] = new_next.strftime("%Y-%m-%d")
+
+    await run_db(update_subscription_fields, existing_id, updates, user_id)
+
+    await asyncio.gather(
+        query.edit_message_text(
+            f"✅ Обновлено\\!\n💰 {escape_md(format_price(amount, currency))}",
+            parse_mode="MarkdownV2"
+        ),
+        run_db(delete_temp_data, temp_id),
+    )
+
+
+async def _dup_create(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Дубликат: всё равно создать новую подписку."""
+    query = update.callback_query
+    temp_id = int(rest)
+
+    temp_data = await run_db(get_temp_data, temp_id, user_id)
+    if not temp_data:
+        await query.edit_message_text(STALE_TEMP_DATA_TEXT)
         return
-    
-    # Запрос на редактирование названия
-    if data.startswith("edit_name:"):
-        try:
-            sub_id = int(data.split(":")[1])
-            sub = get_subscription_if_owner(sub_id, user_id)
-            if sub:
-                context.user_data["edit_sub_id"] = sub_id
-                context.user_data["edit_field"] = "name"
-                await query.edit_message_text(
-                    f"📝 Введи новое название для подписки:\n\n"
-                    f"Текущее: {escape_md(sub['name'])}\n\n"
-                    f"Отправь /cancel для отмены",
-                    parse_mode="MarkdownV2"
-                )
-        except (ValueError, IndexError):
-            pass
+
+    data_parts = temp_data.split("|")
+    if len(data_parts) < 4:
         return
 
+    name, amount_str, currency, date_str = data_parts
+    amount = float(amount_str)
+    price = pack_price(amount, currency)
+
+    category = "📦 Другое"
+    if name.lower() in KNOWN_SERVICES:
+        name, category = KNOWN_SERVICES[name.lower()]
+
+    last_dt = datetime.fromisoformat(date_str) if date_str else datetime.now()
+    next_dt = next_from_last(last_dt, DEFAULT_PERIOD)
+
+    new_id = await run_db(
+        add_subscription_with_payment,
+        user_id=user_id, name=name, price=price,
+        next_date=next_dt.strftime("%Y-%m-%d"),
+        period=DEFAULT_PERIOD,
+        last_charge_date=last_dt.strftime("%Y-%m-%d"),
+        category=category
+    )
+
+    await asyncio.gather(
+        query.edit_message_text(
+            f"✅ Создано: *{escape_md(name)}*\n"
+            f"💰 {escape_md(format_price(amount, currency))}\n"
+            f"📅 {escape_md(format_date(next_dt))}\n\n"
+            f"📅 *Выбери период:*",
+            parse_mode="MarkdownV2",
+            reply_markup=period_keyboard(new_id)
+        ),
+        run_db(delete_temp_data, temp_id),
+    )
+
+
+async def _dup_cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, user_id: int, rest: str) -> None:
+    """Дубликат: отмена, временные данные удаляются."""
+    query = update.callback_query
+    if rest.isdecimal():
+        await run_db(delete_temp_data, int(rest))
+    await query.edit_message_text(CANCELLED_TEXT)
+
+
+DUPLICATE_HANDLERS: Dict[str, Callable[[Update, ContextTypes.DEFAULT_TYPE, int, str], Awaitable[None]]] = {
+    "dup_payment": _dup_payment,
+    "dup_update": _dup_update,
+    "dup_create": _dup_create,
+    "dup_cancel": _dup_cancel,
+}
+
 
 async def duplicate_callback(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик callback-кнопок для дубликатов."""
     query = update.callback_query
     await query.answer()
     
-    data = query.data or ""
-    user_id = query.from_user.id
-    
-    if data.startswith("dup_payment:"):
-        try:
-            parts = data.split(":")
-            if len(parts) < 3:
-                return
-            existing_id = int(parts[1])
-            temp_id = int(parts[2])
-            
-            # Проверяем владельца подписки
-            sub = get_subscription_if_owner(existing_id, user_id)
-            if not sub:
-                await query.edit_message_text("❌ Подписка не найдена.")
-                return
-            
-            # Получаем временные данные
-            temp_data = get_temp_data(temp_id, user_id)
-            if not temp_data:
-                await query.edit_message_text("❌ Данные устарели. Попробуйте снова.")
-                return
-            
-            data_parts = temp_data.split("|")
-            if len(data_parts) < 4:
-                return
-            
-            name, amount_str, currency, date_str = data_parts
-            amount = float(amount_str)
-            price = pack_price(amount, currency)
-            
-            if date_str:
-                last_dt = datetime.fromisoformat(date_str)
-                new_next = next_from_last(last_dt, sub["period"])
-                
-                update_subscription_fields(existing_id, {
-                    "last_charge_date": last_dt.strftime("%Y-%m-%d"),
-                    "price": price,
-                    "next_date": new_next.strftime("%Y-%m-%d")
-                }, user_id)
-                
-                add_payment(user_id, existing_id, price, last_dt.strftime("%Y-%m-%d"))
-                
-                await query.edit_message_text(
-                    f"✅ Платёж записан\\!\n"
-                    f"💰 {escape_md(format_price(amount, currency))}\n"
-                    f"📅 {escape_md(format_date(last_dt))}",
-                    parse_mode="MarkdownV2"
-                )
-            
-            delete_temp_data(temp_id)
-            
-        except Exception as e:
-            logger.error(f"dup_payment error: {e}")
-            await query.edit_message_text("❌ Произошла ошибка.")
-        return
-    
-    elif data.startswith("dup_update:"):
-        try:
-            parts = data.split(":")
-            if len(parts) < 3:
-                return
-            existing_id = int(parts[1])
-            temp_id = int(parts[2])
-            
-            sub = get_subscription_if_owner(existing_id, user_id)
-            if not sub:
-                await query.edit_message_text("❌ Подписка не найдена.")
-                return
-            
-            temp_data = get_temp_data(temp_id, user_id)
-            if not temp_data:
-                await query.edit_message_text("❌ Данные устарели. Попробуйте снова.")
-                return
-            
-            data_parts = temp_data.split("|")
-            if len(data_parts) < 4:
-                return
-            
-            name, amount_str, currency, date_str = data_parts
-            amount = float(amount_str)
-            price = pack_price(amount, currency)
-            
-            updates = {"price": price}
-            
-            if date_str:
-                last_dt = datetime.fromisoformat(date_str)
-                new_next = next_from_last(last_dt, sub["period"])
-                updates["last_charge_date"] = last_dt.strftime("%Y-%m-%d")
-                updates["next_date"] = new_next.strftime("%Y-%m-%d")
-            
-            update_subscription_fields(existing_id, updates, user_id)
-            
-            await query.edit_message_text(
-                f"✅ Обновлено\\!\n💰 {escape_md(format_price(amount, currency))}",
-                parse_mode="MarkdownV2"
-            )
-            
-            delete_temp_data(temp_id)
-            
-        except Exception as e:
-            logger.error(f"dup_update error: {e}")
-            await query.edit_message_text("❌ Произошла ошибка.")
-        return
-    
-    elif data.startswith("dup_create:"):
-        try:
-            parts = data.split(":")
-            if len(parts) < 2:
-                return
-            temp_id = int(parts[1])
-            
-            temp_data = get_temp_data(temp_id, user_id)
-            if not temp_data:
-                await query.edit_message_text("❌ Данные устарели. Попробуйте снова.")
-                return
-            
-            data_parts = temp_data.split("|")
-            if len(data_parts) < 4:
-                return
-            
-            name, amount_str, currency, date_str = data_parts
-            amount = float(amount_str)
-            price = pack_price(amount, currency)
-            
-            category = "📦 Другое"
-            if name.lower() in KNOWN_SERVICES:
-                name, category = KNOWN_SERVICES[name.lower()]
-            
-            last_dt = datetime.fromisoformat(date_str) if date_str else datetime.now()
-            next_dt = next_from_last(last_dt, DEFAULT_PERIOD)
-            
-            new_id = add_subscription(
-                user_id=user_id, name=name, price=price,
-                next_date=next_dt.strftime("%Y-%m-%d"),
-                period=DEFAULT_PERIOD,
-                last_charge_date=last_dt.strftime("%Y-%m-%d"),
-                category=category
-            )
-            add_payment(user_id, new_id, price, last_dt.strftime("%Y-%m-%d"))
-            
-            await query.edit_message_text(
-                f"✅ Создано: *{escape_md(name)}*\n"
-                f"💰 {escape_md(format_price(amount, currency))}\n"
-                f"📅 {escape_md(format_date(next_dt))}\n\n"
-                f"📅 *Выбери период:*",
-                parse_mode="MarkdownV2",
-                reply_markup=period_keyboard(new_id)
-            )
-            
-            delete_temp_data(temp_id)
-            
-        except Exception as e:
-            logger.error(f"dup_create error: {e}")
-            await query.edit_message_text("❌ Произошла ошибка.")
+    # Как и в callback_router: один partition вместо цепочки startswith
+    prefix, _, rest = (query.data or "").partition(":")
+    handler = DUPLICATE_HANDLERS.get(prefix)
+    if handler is None:
         return
-    
-    elif data.startswith("dup_cancel:"):
-        try:
-            parts = data.split(":")
-            if len(parts) >= 2:
-                temp_id = int(parts[1])
-                delete_temp_data(temp_id)
-        except (ValueError, IndexError):
-            pass
-        await query.edit_message_text("Отменено 👌")
+    try:
+        await handler(update, context, query.from_user.id, rest)
+    except Exception as e:
+        logger.error("%s error: %s", prefix, e)
+        await query.edit_message_text("❌ Произошла ошибка.")
 
 
 # ─────────────────────────────────────────────────────────────
 # EDIT HANDLERS (inline editing via messages)
 # ─────────────────────────────────────────────────────────────
+EDIT_STATE_KEYS = ("edit_sub_id", "edit_field")
+
+
+def _clear_edit_state(user_data: Dict[str, Any]) -> None:
+    """Сбрасывает состояние редактирования в user_data."""
+    for key in EDIT_STATE_KEYS:
+        user_data.pop(key, None)
+
+
 async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE) -> bool:
     """Обрабатывает ввод при редактировании. Возвращает True если обработано."""
     user_id = update.effective_user.id
@@ -1914,28 +2365,28 @@ async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     text = update.message.text.strip()
     
-    sub = get_subscription_if_owner(edit_sub_id, user_id)
-    if not sub:
-        context.user_data.pop("edit_sub_id", None)
-        context.user_data.pop("edit_field", None)
-        await update.message.reply_text("❌ Подписка не найдена.", reply_markup=main_menu_keyboard())
+    # Владельца проверяет сам UPDATE: 0 изменённых строк = подписки нет
+    async def reply_not_found() -> bool:
+        await update.message.reply_text(SUB_NOT_FOUND_TEXT, reply_markup=main_menu_keyboard())
         return True
     
     if edit_field == "price":
         parsed = parse_price(text)
         if not parsed:
             await update.message.reply_text(
-                "❌ Не понял цену. Введи число и валюту:\n129 kr, 9.99 EUR, 100\n\n"
-                "Отправь /cancel для отмены"
+                f"{PRICE_PARSE_ERROR_TEXT}\n\nОтправь /cancel для отмены"
             )
             return True
         
         amount, currency = parsed
+        if currency is None:
+            settings = await run_db(get_user_settings, user_id)
+            currency = settings["currency"]
         price = pack_price(amount, currency)
-        update_subscription_field(edit_sub_id, "price", price, user_id)
-        
-        context.user_data.pop("edit_sub_id", None)
-        context.user_data.pop("edit_field", None)
+        # Ввод принят: состояние сбрасываем и при успехе, и если подписки уже нет
+        _clear_edit_state(context.user_data)
+        if not await run_db(update_subscription_field, edit_sub_id, "price", price, user_id):
+            return await reply_not_found()
         
         await update.message.reply_text(
             f"✅ Цена обновлена: {escape_md(format_price(amount, currency))}",
@@ -1947,19 +2398,13 @@ async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
     elif edit_field == "name":
         if len(text) > MAX_NAME_LENGTH:
             await update.message.reply_text(
-                f"❌ Слишком длинное название (макс. {MAX_NAME_LENGTH})\n\n"
-                "Отправь /cancel для отмены"
+                f"{NAME_TOO_LONG_TEXT}\n\nОтправь /cancel для отмены"
             )
             return True
         
-        # Для названия нужно напрямую обновить в БД, т.к. name не в ALLOWED_SUBSCRIPTION_FIELDS
-        with get_db() as conn:
-            c = conn.cursor()
-            c.execute("UPDATE subscriptions SET name = ? WHERE id = ? AND user_id = ?", 
-                      (text, edit_sub_id, user_id))
-        
-        context.user_data.pop("edit_sub_id", None)
-        context.user_data.pop("edit_field", None)
+        _clear_edit_state(context.user_data)
+        if not await run_db(rename_subscription, edit_sub_id, text, user_id):
+            return await reply_not_found()
         
         await update.message.reply_text(
             f"✅ Название обновлено: *{escape_md(text)}*",
@@ -1974,6 +2419,17 @@ async def handle_edit_input(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ─────────────────────────────────────────────────────────────
 # MENU ROUTER
 # ─────────────────────────────────────────────────────────────
+# Кнопки главного меню -> обработчик (один поиск по словарю вместо цепочки if)
+MENU_HANDLERS: Dict[str, Callable[..., Awaitable[Optional[int]]]] = {
+    "📋 Мои подписки": list_cmd,
+    "➕ Добавить": add_start,
+    "📅 Ближайшие": next_cmd,
+    "📊 Статистика": stats_cmd,
+    "⚙️ Настройки": settings_cmd,
+    "❓ Помощь": help_cmd,
+}
+
+
 async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Optional[int]:
     """Роутер главного меню и сообщений."""
     text = update.message.text.strip()
@@ -1984,37 +2440,21 @@ async def menu_router(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Opt
         return None
     
     # Кнопки меню
-    if text == "📋 Мои подписки":
-        await list_cmd(update, context)
-        return None
-    if text == "➕ Добавить":
-        return await add_start(update, context)
-    if text == "📅 Ближайшие":
-        await next_cmd(update, context)
-        return None
-    if text == "📊 Статистика":
-        await stats_cmd(update, context)
-        return None
-    if text == "⚙️ Настройки":
-        await settings_cmd(update, context)
-        return None
-    if text == "❓ Помощь":
-        await help_cmd(update, context)
-        return None
+    handler = MENU_HANDLERS.get(text)
+    if handler:
+        return await handler(update, context)
     
     # Быстрое добавление
     quick = try_parse_quick_add(text)
     if quick:
-        if count_user_subscriptions(user_id) >= MAX_SUBSCRIPTIONS_PER_USER:
-            await update.message.reply_text(
-                f"❌ Лимит: {MAX_SUBSCRIPTIONS_PER_USER} подписок.", 
-                reply_markup=main_menu_keyboard()
-            )
+        count, quick["existing"] = await run_db(get_add_precheck, user_id, quick["name"])
+        if count >= MAX_SUBSCRIPTIONS_PER_USER:
+            await update.message.reply_text(LIMIT_REACHED_TEXT, reply_markup=main_menu_keyboard())
             return None
         return await process_quick_add(update, context, quick)
     
     await update.message.reply_text(
-        "🤔 Не понял\\. Попробуй:\n`Netflix 129 kr 15\\.01\\.26`",
+        f"🤔 Не понял\\. Попробуй:\n{QUICK_ADD_EXAMPLE_MD}",
         parse_mode="MarkdownV2",
         reply_markup=main_menu_keyboard()
     )
@@ -2028,13 +2468,7 @@ async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отладочная команда для просмотра платежей."""
     user_id = update.effective_user.id
     
-    with get_db() as conn:
-        c = conn.cursor()
-        c.execute(
-            "SELECT id, subscription_id, amount, paid_at FROM payment_history WHERE user_id = ?", 
-            (user_id,)
-        )
-        rows = c.fetchall()
+    rows = await run_db(get_payment_history, user_id)
     
     if not rows:
         await update.message.reply_text("Нет платежей в истории")
@@ -2049,14 +2483,14 @@ async def debug_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 async def test_reminder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Тестовая команда для проверки напоминаний."""
     user_id = update.effective_user.id
-    subs = list_subscriptions(user_id)
+    subs = await run_db(list_subscriptions, user_id)
     
     if not subs:
         await update.message.reply_text("У тебя нет подписок для теста")
         return
     
     sub = subs[0]
-    amount, currency = unpack_price(sub["price"])
+    amount, currency = sub["amount"], sub["currency"]
     price_view = format_price(amount, currency)
     
     await update.message.reply_text(
@@ -2073,47 +2507,35 @@ async def test_reminder_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE)
 # ─────────────────────────────────────────────────────────────
 async def send_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Отправляет напоминания о предстоящих платежах."""
-    today = datetime.now().date()
+    today_rd = datetime.now().date().toordinal()
     
-    with get_db() as conn:
-        c = conn.cursor()
-        
-        # Получаем все активные подписки
-        c.execute("""
-            SELECT s.user_id, s.name, s.price, s.next_date
-            FROM subscriptions s
-            WHERE s.is_paused = 0
-        """)
-        all_subs = c.fetchall()
-        
-        # Получаем настройки всех пользователей
-        c.execute("SELECT user_id, reminder_enabled, reminder_days FROM user_settings")
-        settings_rows = c.fetchall()
+    all_subs, settings_rows = await run_db(get_reminder_data)
     
-    user_settings = {}
-    for row in settings_rows:
-        user_settings[row[0]] = {
-            "enabled": bool(row[1]) if row[1] is not None else True, 
-            "days": row[2] or "1,3"
-        }
+    # Настройки разбираем один раз на пользователя, а не на каждую подписку.
+    # None — напоминания выключены.
+    default_days = frozenset((1, 3))
+    user_reminder_days: Dict[int, Optional[frozenset]] = {}
+    for user_id, enabled, days_str in settings_rows:
+        if enabled is not None and not enabled:
+            user_reminder_days[user_id] = None
+            continue
+        try:
+            user_reminder_days[user_id] = frozenset(int(d.strip()) for d in (days_str or "1,3").split(","))
+        except ValueError:
+            user_reminder_days[user_id] = default_days
     
+    send_message = context.bot.send_message
     for sub in all_subs:
-        user_id, name, price_str, next_date = sub
+        user_id, name, amount, currency, next_date = sub
         try:
-            settings = user_settings.get(user_id, {"enabled": True, "days": "1,3"})
-            if not settings["enabled"]:
+            reminder_days = user_reminder_days.get(user_id, default_days)
+            if reminder_days is None:
                 continue
             
-            dt = datetime.strptime(next_date, "%Y-%m-%d").date()
-            days_left = (dt - today).days
-            
-            try:
-                reminder_days = [int(d.strip()) for d in settings["days"].split(",")]
-            except ValueError:
-                reminder_days = [1, 3]
+            # Разница номеров дней — обычное вычитание целых вместо strptime и timedelta
+            days_left = parse_iso_date(next_date).toordinal() - today_rd
             
             if days_left in reminder_days:
-                amount, currency = unpack_price(price_str)
                 price_view = format_price(amount, currency)
                 
                 if days_left == 1:
@@ -2123,7 +2545,7 @@ async def send_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
                 else:
                     when = f"Через {days_left} дн."
                 
-                await context.bot.send_message(
+                await send_message(
                     chat_id=user_id,
                     text=f"⏰ *Напоминание*\n\n{when} оплата *{escape_md(name)}*\n💰 {escape_md(price_view)}",
                     parse_mode="MarkdownV2"
@@ -2136,7 +2558,7 @@ async def send_reminders(context: ContextTypes.DEFAULT_TYPE) -> None:
 
 async def cleanup_temp_data_job(context: ContextTypes.DEFAULT_TYPE) -> None:
     """Job для очистки устаревших временных данных."""
-    cleanup_expired_temp_data()
+    await run_db(cleanup_expired_temp_data)
     logger.info("Cleaned up expired temp data")
 
 
@@ -2145,7 +2567,10 @@ async def cleanup_temp_data_job(context: ContextTypes.DEFAULT_TYPE) -> None:
 # ─────────────────────────────────────────────────────────────
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Обработчик ошибок."""
-    logger.error(f"Exception: {context.error}", exc_info=True)
+    # Ленивое %-форматирование: строка и трейсбек собираются, только если запись
+    # действительно выводится. exc_info берём из context.error — обработчик
+    # вызывается вне except, и exc_info=True здесь трейсбека не даёт
+    logger.error("Exception: %s", context.error, exc_info=context.error)
     
     if update and update.effective_message:
         try:
@@ -2160,6 +2585,54 @@ async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE) -> N
 # ─────────────────────────────────────────────────────────────
 # MAIN
 # ─────────────────────────────────────────────────────────────
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает апдейты разных пользователей параллельно, а апдейты одного
+    пользователя — строго по очереди. ConversationHandler и user_data не
+    рассчитаны на конкурентный доступ: без этого цена, отправленная во время
+    await в add_flow_name, была бы принята как второе название.
+    
+    Семафор базового класса берётся до do_process_update, и апдейты, ждущие
+    замок своего пользователя, занимали бы его слоты. Поэтому базовому классу
+    отдаём практически неограниченный лимит, а max_concurrent_updates держим
+    своим семафором, который берётся уже под замком пользователя.
+    """
+    
+    def __init__(self, max_concurrent_updates: int) -> None:
+        super().__init__(1_000_000)
+        self._slots = asyncio.Semaphore(max_concurrent_updates)
+        self._locks: Dict[int, asyncio.Lock] = {}
+        self._waiters: Dict[int, int] = {}
+    
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._slots:
+                await coroutine
+            return
+        
+        user_id = user.id
+        lock = self._locks.get(user_id)
+        if lock is None:
+            lock = self._locks[user_id] = asyncio.Lock()
+        self._waiters[user_id] = self._waiters.get(user_id, 0) + 1
+        try:
+            async with lock, self._slots:
+                await coroutine
+        finally:
+            # Замок удаляем, когда очередь пользователя опустела, чтобы словарь не рос
+            self._waiters[user_id] -= 1
+            if not self._waiters[user_id]:
+                del self._waiters[user_id]
+                del self._locks[user_id]
+    
+    async def initialize(self) -> None:
+        pass
+    
+    async def shutdown(self) -> None:
+        pass
+
+
 async def post_init(app: Application) -> None:
     """Инициализация после запуска."""
     await app.bot.delete_webhook(drop_pending_updates=True)
@@ -2167,6 +2640,11 @@ async def post_init(app: Application) -> None:
     logger.info(f"✅ Bot running: @{me.username} (id={me.id})")
 
 
+async def post_shutdown(app: Application) -> None:
+    """Освобождение ресурсов при остановке."""
+    close_db()
+
+
 def main() -> None:
     """Главная функция запуска бота."""
     if not BOT_TOKEN:
@@ -2176,7 +2654,14 @@ def main() -> None:
     init_db()
     logger.info("🚀 CODE VERSION: 2026-01-04 v7 (fixed + period selection)")
     
-    application = Application.builder().token(BOT_TOKEN).post_init(post_init).build()
+    application = (
+        Application.builder()
+        .token(BOT_TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Настройка job queue для напоминаний
     job_queue = application.job_queue
@@ -2199,31 +2684,32 @@ def main() -> None:
         logger.info("Temp data cleanup scheduled")
     
     # Conversation handler для добавления подписок
+    cancel_handler = MessageHandler(filters.Regex(CANCEL_BUTTON_RE), cancel)
     add_conv = ConversationHandler(
         entry_points=[
             CommandHandler("add", add_start),
-            MessageHandler(filters.Regex(r"^➕ Добавить$"), add_start),
+            MessageHandler(filters.Regex(ADD_BUTTON_RE), add_start),
         ],
         states={
             ADD_NAME: [
-                MessageHandler(filters.Regex(r"^❌ Отмена$"), cancel),
+                cancel_handler,
                 MessageHandler(filters.TEXT & ~filters.COMMAND, add_flow_name),
             ],
             ADD_PRICE: [
-                MessageHandler(filters.Regex(r"^❌ Отмена$"), cancel),
+                cancel_handler,
                 MessageHandler(filters.TEXT & ~filters.COMMAND, add_flow_price),
             ],
             ADD_DATE: [
-                MessageHandler(filters.Regex(r"^❌ Отмена$"), cancel),
+                cancel_handler,
                 MessageHandler(filters.TEXT & ~filters.COMMAND, add_flow_date),
             ],
             ADD_PERIOD: [
-                CallbackQueryHandler(add_flow_period_callback, pattern=r"^add_period:"),
+                CallbackQueryHandler(add_flow_period_callback, pattern=ADD_PERIOD_CALLBACK_RE),
             ],
         },
         fallbacks=[
             CommandHandler("cancel", cancel),
-            MessageHandler(filters.Regex(r"^❌ Отмена$"), cancel),
+            cancel_handler,
         ],
         allow_reentry=True,
     )
@@ -2241,8 +2727,8 @@ def main() -> None:
     application.add_handler(add_conv)
     
     # Callback handlers
-    application.add_handler(CallbackQueryHandler(settings_callback, pattern=r"^(settings:|set_)"))
-    application.add_handler(CallbackQueryHandler(duplicate_callback, pattern=r"^dup_"))
+    application.add_handler(CallbackQueryHandler(settings_callback, pattern=SETTINGS_CALLBACK_RE))
+    application.add_handler(CallbackQueryHandler(duplicate_callback, pattern=DUPLICATE_CALLBACK_RE))
     application.add_handler(CallbackQueryHandler(callback_router))
     
     # Обработчик текстовых сообщений (меню и быстрое добавление)